@@ -1,15 +1,26 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, HTTPException, Body, Header, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 import os
+import asyncio
 import logging
+import time
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional
+from pydantic import BaseModel, Field, ConfigDict, ValidationError, field_validator
+from typing import Any, List, Optional, Set
+from collections import OrderedDict
 import uuid
-from datetime import datetime, timezone
-import requests
+import base64
+import math
+import random
+import hashlib
+import json
+from datetime import datetime, timedelta, timezone
+import httpx
 
 
 ROOT_DIR = Path(__file__).parent
@@ -17,12 +28,120 @@ load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, tz_aware=True)
 db = client[os.environ['DB_NAME']]
 
+# How locations are stored: "collection" (one document per point), "timeseries"
+# (db.locations as a time-series collection) or "buckets" (db.location_buckets,
+# one document per device per LOCATION_BUCKET_SECONDS window)
+LOCATION_STORAGE = os.environ.get('LOCATION_STORAGE', 'collection').lower()
+if LOCATION_STORAGE not in ('collection', 'timeseries', 'buckets'):
+    raise RuntimeError(f"Unknown LOCATION_STORAGE {LOCATION_STORAGE!r}")
+TIMESERIES_STORAGE = LOCATION_STORAGE == 'timeseries'
+BUCKET_STORAGE = LOCATION_STORAGE == 'buckets'
+# Only the plain collection has a unique index on location ids
+UNIQUE_LOCATION_IDS = LOCATION_STORAGE == 'collection'
+LOCATION_BUCKET_SECONDS = int(os.environ.get('LOCATION_BUCKET_SECONDS', '3600'))
+
+# Largest number of points accepted by a single batch upload
+LOCATION_BATCH_MAX = int(os.environ.get('LOCATION_BATCH_MAX', '5000'))
+# How far ahead of server time a buffered point's device clock may run
+LOCATION_MAX_CLOCK_SKEW_S = float(os.environ.get('LOCATION_MAX_CLOCK_SKEW_S', '120'))
+# History paging: default and largest page size for GET /api/locations
+LOCATIONS_PAGE_SIZE = int(os.environ.get('LOCATIONS_PAGE_SIZE', '100'))
+LOCATIONS_PAGE_MAX = int(os.environ.get('LOCATIONS_PAGE_MAX', '1000'))
+# Stationary suppression: a point is stored only if it moved more than the larger of
+# MOVEMENT_MIN_DISTANCE_M and accuracy * MOVEMENT_ACCURACY_FACTOR, or MOVEMENT_MAX_INTERVAL_S passed
+MOVEMENT_MIN_DISTANCE_M = float(os.environ.get('MOVEMENT_MIN_DISTANCE_M', '10'))
+MOVEMENT_ACCURACY_FACTOR = float(os.environ.get('MOVEMENT_ACCURACY_FACTOR', '1.0'))
+MOVEMENT_MAX_INTERVAL_S = float(os.environ.get('MOVEMENT_MAX_INTERVAL_S', '60'))
+# Ingest filtering: fixes less accurate than INGEST_MAX_ACCURACY_M or implying a speed above
+# INGEST_MAX_SPEED_MPS are rejected; KALMAN_PROCESS_NOISE is how sharply (m/s^2) a device may
+# change speed
+INGEST_MAX_ACCURACY_M = float(os.environ.get('INGEST_MAX_ACCURACY_M', '500'))
+INGEST_MAX_SPEED_MPS = float(os.environ.get('INGEST_MAX_SPEED_MPS', '70'))
+INGEST_MAX_CONSECUTIVE_OUTLIERS = int(os.environ.get('INGEST_MAX_CONSECUTIVE_OUTLIERS', '3'))
+KALMAN_PROCESS_NOISE = float(os.environ.get('KALMAN_PROCESS_NOISE', '3'))
+# Keep every raw fix, including rejected ones, in locations_raw
+INGEST_STORE_RAW = os.environ.get('INGEST_STORE_RAW', 'false').lower() in ('1', 'true', 'yes')
+# Recommended report interval bounds, distance a device should cover between reports,
+# and dispatch backlog at which clients are asked to report half as often
+REPORT_INTERVAL_MIN_MS = int(os.environ.get('REPORT_INTERVAL_MIN_MS', '2000'))
+REPORT_INTERVAL_DEFAULT_MS = int(os.environ.get('REPORT_INTERVAL_DEFAULT_MS', '5000'))
+REPORT_INTERVAL_MAX_MS = int(os.environ.get('REPORT_INTERVAL_MAX_MS', '60000'))
+REPORT_TARGET_DISTANCE_M = float(os.environ.get('REPORT_TARGET_DISTANCE_M', '25'))
+REPORT_QUEUE_HIGH_WATER = int(os.environ.get('REPORT_QUEUE_HIGH_WATER', '1000'))
+# Recently shared locations remembered for replaying retried requests
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', '10000'))
+IDEMPOTENCY_TTL_SECONDS = float(os.environ.get('IDEMPOTENCY_TTL_SECONDS', '600'))
+# Per-device and per-chat state held in memory: most keys kept, and how long an idle one survives
+STATE_MAX_KEYS = int(os.environ.get('STATE_MAX_KEYS', '10000'))
+STATE_IDLE_SECONDS = float(os.environ.get('STATE_IDLE_SECONDS', '86400'))
+# Live update fan-out: recent points sent on connect, per-subscriber buffer
+WS_SNAPSHOT_SIZE = int(os.environ.get('WS_SNAPSHOT_SIZE', '20'))
+SUBSCRIBER_QUEUE_SIZE = int(os.environ.get('SUBSCRIBER_QUEUE_SIZE', '256'))
+# SSE: keep-alive comment interval and points replayed on Last-Event-ID resume
+SSE_HEARTBEAT_SECONDS = float(os.environ.get('SSE_HEARTBEAT_SECONDS', '15'))
+SSE_BACKFILL_LIMIT = int(os.environ.get('SSE_BACKFILL_LIMIT', '1000'))
+# Documents converted per round trip by the timestamp migration
+MIGRATION_BATCH_SIZE = int(os.environ.get('MIGRATION_BATCH_SIZE', '500'))
+# Retention, in days (0 keeps forever): stored points, and their rollups per resolution
+LOCATION_RETENTION_DAYS = float(os.environ.get('LOCATION_RETENTION_DAYS', '0'))
+ROLLUP_RETENTION_DAYS = float(os.environ.get('ROLLUP_RETENTION_DAYS', '365'))
+ROLLUP_15M_RETENTION_DAYS = float(os.environ.get('ROLLUP_15M_RETENTION_DAYS', '90'))
+ROLLUP_1M_RETENTION_DAYS = float(os.environ.get('ROLLUP_1M_RETENTION_DAYS', '30'))
+# How often MongoDB's TTL monitor removes expired documents (its ttlMonitorSleepSecs)
+TTL_MONITOR_SECONDS = float(os.environ.get('TTL_MONITOR_SECONDS', '60'))
+# Rollup resolutions, finest first: name (stored in locations_<name>), window seconds, retention days
+ROLLUPS = [
+    ("1m", 60, ROLLUP_1M_RETENTION_DAYS),
+    ("15m", 900, ROLLUP_15M_RETENTION_DAYS),
+    ("1h", 3600, ROLLUP_RETENTION_DAYS),
+]
+# Rollup reconciliation: how often it runs, how far back it recomputes to pick up
+# late uploads, and points read per round trip
+ROLLUP_INTERVAL_SECONDS = float(os.environ.get('ROLLUP_INTERVAL_SECONDS', '3600'))
+ROLLUP_LOOKBACK_SECONDS = int(os.environ.get('ROLLUP_LOOKBACK_SECONDS', '86400'))
+ROLLUP_BATCH_SIZE = int(os.environ.get('ROLLUP_BATCH_SIZE', '1000'))
+# Background deletes: documents removed per batch and pause between batches
+DELETE_BATCH_SIZE = int(os.environ.get('DELETE_BATCH_SIZE', '1000'))
+DELETE_BATCH_PAUSE_SECONDS = float(os.environ.get('DELETE_BATCH_PAUSE_SECONDS', '0.1'))
+# How long finished jobs stay visible through GET /api/jobs/{id}
+JOB_RETENTION_SECONDS = int(os.environ.get('JOB_RETENTION_SECONDS', '604800'))
+
 # Telegram configuration
 TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
 TELEGRAM_CHAT_ID = os.environ.get('TELEGRAM_CHAT_ID')
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org').rstrip('/')
+TELEGRAM_TIMEOUT = float(os.environ.get('TELEGRAM_TIMEOUT', '10'))
+TELEGRAM_CONNECT_TIMEOUT = float(os.environ.get('TELEGRAM_CONNECT_TIMEOUT', '5'))
+TELEGRAM_MAX_CONNECTIONS = int(os.environ.get('TELEGRAM_MAX_CONNECTIONS', '20'))
+TELEGRAM_MAX_KEEPALIVE = int(os.environ.get('TELEGRAM_MAX_KEEPALIVE', '10'))
+TELEGRAM_KEEPALIVE_EXPIRY = float(os.environ.get('TELEGRAM_KEEPALIVE_EXPIRY', '60'))
+TELEGRAM_HTTP2 = os.environ.get('TELEGRAM_HTTP2', 'false').lower() in ('1', 'true', 'yes')
+# Seconds a live location message stays editable; 0 sends a new message per point
+TELEGRAM_LIVE_PERIOD = int(os.environ.get('TELEGRAM_LIVE_PERIOD', '86400'))
+# Outbound budgets (requests per second and burst), globally and per chat
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', '30'))
+TELEGRAM_GLOBAL_BURST = float(os.environ.get('TELEGRAM_GLOBAL_BURST', '30'))
+TELEGRAM_CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', '1'))
+TELEGRAM_CHAT_BURST = float(os.environ.get('TELEGRAM_CHAT_BURST', '3'))
+# Retries of a call rejected with 429
+TELEGRAM_MAX_RETRIES = int(os.environ.get('TELEGRAM_MAX_RETRIES', '3'))
+# Circuit breaker: consecutive failures that open it, seconds before a trial call, trial calls allowed
+TELEGRAM_BREAKER_FAILURES = int(os.environ.get('TELEGRAM_BREAKER_FAILURES', '5'))
+TELEGRAM_BREAKER_RESET = float(os.environ.get('TELEGRAM_BREAKER_RESET', '30'))
+TELEGRAM_BREAKER_HALF_OPEN_CALLS = int(os.environ.get('TELEGRAM_BREAKER_HALF_OPEN_CALLS', '1'))
+# Durable outbox: poll interval, claim lease, retry backoff and retention of delivered rows
+OUTBOX_POLL_SECONDS = float(os.environ.get('OUTBOX_POLL_SECONDS', '2'))
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', '100'))
+OUTBOX_LEASE_SECONDS = float(os.environ.get('OUTBOX_LEASE_SECONDS', '60'))
+OUTBOX_BASE_DELAY = float(os.environ.get('OUTBOX_BASE_DELAY', '2'))
+OUTBOX_MAX_DELAY = float(os.environ.get('OUTBOX_MAX_DELAY', '600'))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '8'))
+OUTBOX_RETENTION_SECONDS = int(os.environ.get('OUTBOX_RETENTION_SECONDS', '86400'))
+TELEGRAM_WORKERS = int(os.environ.get('TELEGRAM_WORKERS', '4'))
+TELEGRAM_QUEUE_SIZE = int(os.environ.get('TELEGRAM_QUEUE_SIZE', '10000'))
 
 # Create the main app without a prefix
 app = FastAPI()
@@ -40,29 +159,1907 @@ class Location(BaseModel):
     longitude: float
     accuracy: Optional[float] = None
     timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    device_id: Optional[str] = None
+    session_id: Optional[str] = None
 
 class LocationCreate(BaseModel):
+    # Optional client-generated id; resending the same id never stores the point twice
+    id: Optional[str] = Field(None, min_length=1, max_length=64)
     latitude: float
     longitude: float
     accuracy: Optional[float] = None
+    device_id: Optional[str] = Field(None, min_length=1, max_length=64)
+    session_id: Optional[str] = Field(None, min_length=1, max_length=64)
+
+class LocationShareResult(Location):
+    # How long the client should wait before reporting again
+    next_report_ms: int
+
+class LocationBatchItem(LocationCreate):
+    # Buffered points keep the time they were recorded on the device
+    timestamp: Optional[datetime] = None
+
+    @field_validator("timestamp")
+    @classmethod
+    def not_in_future(cls, value: Optional[datetime]) -> Optional[datetime]:
+        # A point from the future would outrank every later share of its device
+        if value is None:
+            return value
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        if value > datetime.now(timezone.utc) + timedelta(seconds=LOCATION_MAX_CLOCK_SKEW_S):
+            raise ValueError(f"more than {LOCATION_MAX_CLOCK_SKEW_S:g}s ahead of server time")
+        return value
+
+class LocationBatchItemResult(BaseModel):
+    index: int
+    status: str
+    id: Optional[str] = None
+    error: Optional[str] = None
+
+class LocationBatchResult(BaseModel):
+    created: int
+    duplicates: int = 0
+    # Fixes the ingest filter turned away as outliers or too inaccurate
+    rejected: int = 0
+    failed: int
+    results: List[LocationBatchItemResult]
+
+class Job(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    type: str
+    # pending, running, done or failed
+    status: str = "pending"
+    params: dict = Field(default_factory=dict)
+    processed: int = 0
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    finished_at: Optional[datetime] = None
+    error: Optional[str] = None
+
+
+# In-memory state
+class RecentMap:
+    """LRU map that forgets keys idle for longer than ttl, so client-chosen keys can't pile up"""
+
+    def __init__(self, maxsize: int = STATE_MAX_KEYS, ttl: float = STATE_IDLE_SECONDS):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        if time.monotonic() - entry[0] > self.ttl:
+            del self._entries[key]
+            return default
+        self._entries[key] = (time.monotonic(), entry[1])
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def __setitem__(self, key, value):
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        # Oldest first: drop everything idle too long, then trim to size
+        now = time.monotonic()
+        while self._entries:
+            oldest_key, (touched, _) = next(iter(self._entries.items()))
+            if len(self._entries) <= self.maxsize and now - touched <= self.ttl:
+                break
+            del self._entries[oldest_key]
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
 
 
 # Telegram Bot Functions
-def send_location_to_telegram(latitude: float, longitude: float):
-    """Send location to Telegram bot"""
+class TokenBucket:
+    """Token bucket refilled continuously at rate tokens per second"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self) -> float:
+        """Seconds until a token can be taken"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class TelegramRateLimiter:
+    """Global and per-chat budgets for outbound Bot API calls"""
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_BURST)
+        self.chat_buckets = RecentMap()
+        self.throttled = 0
+        self.retry_after_hits = 0
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST)
+        return bucket
+
+    async def acquire(self, chat_id):
+        chat_bucket = self._chat_bucket(chat_id)
+        throttled = False
+        while True:
+            wait = max(self.global_bucket.delay(), chat_bucket.delay())
+            if wait <= 0:
+                self.global_bucket.take()
+                chat_bucket.take()
+                break
+            throttled = True
+            await asyncio.sleep(wait)
+        if throttled:
+            self.throttled += 1
+
+    def retry_after(self, chat_id, seconds: float):
+        """Hold back a chat for as long as Telegram asked"""
+        self.retry_after_hits += 1
+        self._chat_bucket(chat_id).block(seconds)
+
+    def stats(self) -> dict:
+        return {
+            "throttled": self.throttled,
+            "retry_after_hits": self.retry_after_hits,
+            "chats": len(self.chat_buckets),
+        }
+
+
+telegram_rate_limiter = TelegramRateLimiter()
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling Telegram while the circuit is open"""
+
+    def __init__(self, retry_in: float):
+        super().__init__(f"Telegram circuit is open, retrying in {retry_in:.1f}s")
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker around an unreliable dependency"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float, half_open_calls: int):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self._state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trials = 0
+        self.rejected = 0
+        self.times_opened = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+            self._trials = 0
+        return self._state
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go out now"""
+        state = self.state
+        if state == self.CLOSED:
+            return
+        if state == self.HALF_OPEN and self._trials < self.half_open_calls:
+            self._trials += 1
+            return
+        self.rejected += 1
+        raise CircuitOpenError(max(0.0, self.opened_at + self.reset_timeout - time.monotonic()))
+
+    def release_trial(self):
+        """Give back a half-open trial whose call never got an answer either way"""
+        if self._state == self.HALF_OPEN and self._trials > 0:
+            self._trials -= 1
+
+    def record_success(self):
+        self._state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self._state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self._state != self.OPEN:
+                self.times_opened += 1
+                logger.warning(f"Telegram circuit opened after {self.failures} consecutive failures")
+            self._state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        state = self.state
+        return {
+            "state": state,
+            "consecutive_failures": self.failures,
+            "retry_in": max(0.0, self.opened_at + self.reset_timeout - time.monotonic()) if state == self.OPEN else 0.0,
+            "rejected": self.rejected,
+            "times_opened": self.times_opened,
+        }
+
+
+telegram_breaker = CircuitBreaker(TELEGRAM_BREAKER_FAILURES, TELEGRAM_BREAKER_RESET, TELEGRAM_BREAKER_HALF_OPEN_CALLS)
+
+
+def _retry_after(response: httpx.Response) -> float:
     try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendLocation"
-        payload = {
-            "chat_id": TELEGRAM_CHAT_ID,
+        return float(response.json().get("parameters", {}).get("retry_after", 1))
+    except (ValueError, AttributeError):
+        return 1.0
+
+
+class TelegramClient:
+    """Long-lived pooled HTTP client for the Telegram Bot API"""
+
+    def __init__(self, base_url: str, token: Optional[str]):
+        self.base_url = base_url
+        self.token = token
+        self._http: Optional[httpx.AsyncClient] = None
+
+    async def start(self):
+        limits = httpx.Limits(
+            max_connections=TELEGRAM_MAX_CONNECTIONS,
+            max_keepalive_connections=TELEGRAM_MAX_KEEPALIVE,
+            keepalive_expiry=TELEGRAM_KEEPALIVE_EXPIRY,
+        )
+        timeout = httpx.Timeout(TELEGRAM_TIMEOUT, connect=TELEGRAM_CONNECT_TIMEOUT)
+        http2 = TELEGRAM_HTTP2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("TELEGRAM_HTTP2 is set but the h2 package is not installed, using HTTP/1.1")
+                http2 = False
+        self._http = httpx.AsyncClient(
+            base_url=f"{self.base_url}/bot{self.token}",
+            limits=limits,
+            timeout=timeout,
+            http2=http2,
+        )
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    async def call(self, method: str, payload: dict) -> dict:
+        """Call a Bot API method and return the decoded response"""
+        if self._http is None:
+            raise RuntimeError("Telegram client is not started")
+        chat_id = payload.get("chat_id")
+        for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+            telegram_breaker.before_call()
+            try:
+                await telegram_rate_limiter.acquire(chat_id)
+                response = await self._http.post(f"/{method}", json=payload)
+            except httpx.HTTPError:
+                telegram_breaker.record_failure()
+                raise
+            except BaseException:
+                # Cancelled or broken before Telegram answered; don't strand a half-open trial
+                telegram_breaker.release_trial()
+                raise
+            if response.status_code >= 500:
+                telegram_breaker.record_failure()
+            else:
+                # Any answer below 500, even a 4xx, shows the API is reachable
+                telegram_breaker.record_success()
+            if response.status_code == 429 and attempt < TELEGRAM_MAX_RETRIES:
+                retry_after = _retry_after(response)
+                telegram_rate_limiter.retry_after(chat_id, retry_after)
+                logger.warning(f"Telegram rate limited {method} for chat {chat_id}, retrying in {retry_after}s")
+                continue
+            response.raise_for_status()
+            return response.json()
+
+
+telegram_client = TelegramClient(TELEGRAM_API_URL, TELEGRAM_BOT_TOKEN)
+
+
+class LiveLocationSession:
+    """Live location message being edited for one device in one chat"""
+
+    __slots__ = ("message_id", "expires_at")
+
+    def __init__(self):
+        self.message_id: Optional[int] = None
+        self.expires_at = 0.0
+
+
+live_sessions = RecentMap()
+
+# Stop editing a little before Telegram closes the live period
+LIVE_PERIOD_MARGIN = 5.0
+
+
+def _telegram_error(error: httpx.HTTPStatusError) -> str:
+    try:
+        return error.response.json().get("description", "")
+    except ValueError:
+        return error.response.text
+
+
+async def _push_live_location(chat_id: str, session: LiveLocationSession, latitude: float, longitude: float):
+    now = time.monotonic()
+    if session.message_id is not None and now < session.expires_at - LIVE_PERIOD_MARGIN:
+        try:
+            return await telegram_client.call("editMessageLiveLocation", {
+                "chat_id": chat_id,
+                "message_id": session.message_id,
+                "latitude": latitude,
+                "longitude": longitude,
+            })
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 400:
+                raise
+            description = _telegram_error(e)
+            if "message is not modified" in description:
+                return None
+            # Deleted or stopped by the user: fall through and start a new live message
+            logger.info(f"Live location message {session.message_id} can't be edited ({description}), starting a new one")
+
+    result = await telegram_client.call("sendLocation", {
+        "chat_id": chat_id,
+        "latitude": latitude,
+        "longitude": longitude,
+        "live_period": TELEGRAM_LIVE_PERIOD,
+    })
+    session.message_id = result["result"]["message_id"]
+    session.expires_at = now + TELEGRAM_LIVE_PERIOD
+    return result
+
+
+async def send_location_to_telegram(
+    latitude: float,
+    longitude: float,
+    chat_id: Optional[str] = None,
+    device_id: Optional[str] = None,
+):
+    """Send location to Telegram bot
+
+    In live mode the first point of each device starts a live location
+    message and later points edit it. The dispatcher never runs two sends for
+    one device and chat at once.
+    """
+    chat_id = chat_id or TELEGRAM_CHAT_ID
+    try:
+        if TELEGRAM_LIVE_PERIOD <= 0:
+            payload = {
+                "chat_id": chat_id,
+                "latitude": latitude,
+                "longitude": longitude
+            }
+            return await telegram_client.call("sendLocation", payload)
+
+        key = (chat_id, device_id or DEFAULT_DEVICE_ID)
+        session = live_sessions.get(key)
+        if session is None:
+            session = live_sessions[key] = LiveLocationSession()
+        return await _push_live_location(chat_id, session, latitude, longitude)
+    except Exception as e:
+        logger.error(f"Failed to send location to Telegram: {e}")
+        raise
+
+
+class PendingPoint:
+    """Freshest undelivered point of a chat and the outbox rows it stands for"""
+
+    __slots__ = ("enqueued_at", "timestamp", "latitude", "longitude", "outbox_id", "outbox_ids")
+
+    def __init__(self, timestamp: datetime, latitude: float, longitude: float, outbox_id: Optional[str]):
+        self.enqueued_at = time.monotonic()
+        self.timestamp = timestamp
+        self.latitude = latitude
+        self.longitude = longitude
+        # Row of the point in the slot; every other id in outbox_ids is older
+        self.outbox_id = outbox_id
+        self.outbox_ids: List[str] = [outbox_id] if outbox_id is not None else []
+
+
+class TelegramDispatcher:
+    """Delivers locations to Telegram off the request path
+
+    Each device in each chat has a single pending slot holding its freshest
+    point, so a backlog collapses to one send per device instead of growing
+    with pings.
+    """
+
+    def __init__(self, workers: int, maxsize: int):
+        self.workers = workers
+        self.maxsize = maxsize
+        # (chat, device) slots with a pending point that are not already being sent
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._pending: dict = {}
+        self._in_flight: Set[tuple] = set()
+        # Timestamp of the last point delivered to each (chat, device)
+        self._delivered = RecentMap()
+        self._tasks: List[asyncio.Task] = []
+        self._outbox_updates: Set[asyncio.Task] = set()
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.last_drain_latency: Optional[float] = None
+        self.max_drain_latency = 0.0
+        self._total_drain_latency = 0.0
+
+    def enqueue(
+        self,
+        latitude: float,
+        longitude: float,
+        chat_id: Optional[str] = None,
+        timestamp: Optional[datetime] = None,
+        outbox_id: Optional[str] = None,
+        device_id: Optional[str] = None,
+    ) -> bool:
+        """Make this the device's next point to send; returns False if too many slots are waiting"""
+        key = (chat_id or TELEGRAM_CHAT_ID, device_id or DEFAULT_DEVICE_ID)
+        timestamp = timestamp or datetime.now(timezone.utc)
+        if self.is_superseded(key, timestamp):
+            # Telegram already shows a newer point for this device
+            if outbox_id is not None:
+                self._run_outbox_update(telegram_outbox.superseded([outbox_id]))
+            self.coalesced += 1
+            return True
+        point = self._pending.get(key)
+        if point is not None:
+            # Only a fresher point replaces the slot; the enqueue time is kept for the latency figures
+            if timestamp >= point.timestamp:
+                point.timestamp, point.latitude, point.longitude = timestamp, latitude, longitude
+                point.outbox_id = outbox_id
+            if outbox_id is not None:
+                point.outbox_ids.append(outbox_id)
+            self.coalesced += 1
+            return True
+        if len(self._pending) >= self.maxsize:
+            self.dropped += 1
+            logger.warning("Telegram dispatch queue is full, dropping location")
+            return False
+        self._pending[key] = PendingPoint(timestamp, latitude, longitude, outbox_id)
+        if key not in self._in_flight:
+            self._ready.put_nowait(key)
+        return True
+
+    def is_superseded(self, key: tuple, timestamp: datetime) -> bool:
+        delivered = self._delivered.get(key)
+        return delivered is not None and timestamp <= delivered
+
+    def _run_outbox_update(self, update):
+        task = asyncio.create_task(update)
+        # Keep a reference until it finishes so it isn't garbage collected mid-flight
+        self._outbox_updates.add(task)
+        task.add_done_callback(self._outbox_updates.discard)
+
+    async def start(self):
+        for i in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(), name=f"telegram-worker-{i}"))
+        logger.info(f"Started {self.workers} Telegram dispatch workers")
+
+    async def stop(self, timeout: float = 5.0):
+        """Give pending sends a chance to drain, then cancel the workers"""
+        try:
+            await asyncio.wait_for(self._ready.join(), timeout)
+        except asyncio.TimeoutError:
+            # Their outbox rows are picked up again once the lease runs out
+            logger.warning(f"Stopping with {len(self._pending)} undelivered Telegram locations")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            point = self._pending.pop(key)
+            self._in_flight.add(key)
+            try:
+                if self.is_superseded(key, point.timestamp):
+                    # A newer point was delivered while this one waited
+                    await telegram_outbox.superseded(point.outbox_ids)
+                    continue
+                try:
+                    await send_location_to_telegram(point.latitude, point.longitude, *key)
+                except Exception as e:
+                    self.failed += 1
+                    await telegram_outbox.failed(point.outbox_id, point.outbox_ids, e)
+                else:
+                    self.sent += 1
+                    self._delivered[key] = point.timestamp
+                    await telegram_outbox.delivered(point.outbox_id, point.outbox_ids)
+            except Exception as e:
+                logger.error(f"Failed to update Telegram outbox: {e}")
+            finally:
+                self._in_flight.discard(key)
+                if key in self._pending:
+                    # A fresher point arrived while this one was in flight
+                    self._ready.put_nowait(key)
+                latency = time.monotonic() - point.enqueued_at
+                self.last_drain_latency = latency
+                self.max_drain_latency = max(self.max_drain_latency, latency)
+                self._total_drain_latency += latency
+                self._ready.task_done()
+
+    def stats(self) -> dict:
+        processed = self.sent + self.failed
+        return {
+            "workers": self.workers,
+            "queue_depth": len(self._pending),
+            "queue_capacity": self.maxsize,
+            "in_flight": len(self._in_flight),
+            "sent": self.sent,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "live_sessions": len(live_sessions),
+            "last_drain_latency": self.last_drain_latency,
+            "avg_drain_latency": self._total_drain_latency / processed if processed else None,
+            "max_drain_latency": self.max_drain_latency,
+            "rate_limiter": telegram_rate_limiter.stats(),
+            "circuit": telegram_breaker.stats(),
+        }
+
+
+telegram_dispatcher = TelegramDispatcher(TELEGRAM_WORKERS, TELEGRAM_QUEUE_SIZE)
+
+
+# Telegram Outbox
+class TelegramOutbox:
+    """Durable record of every point still owed to Telegram
+
+    Rows are written with the location and leased to the dispatcher; a row
+    whose send failed, or whose lease ran out because the process died, is
+    picked up again by the poller after a jittered exponential backoff.
+    """
+
+    def __init__(self):
+        self.supports_transactions = False
+        self.dead = 0
+
+    async def detect_transactions(self):
+        try:
+            hello = await client.admin.command("hello")
+        except Exception:
+            hello = {}
+        self.supports_transactions = "setName" in hello or hello.get("msg") == "isdbgrid"
+        if TIMESERIES_STORAGE:
+            # Time-series collections can't be written inside a multi-document transaction
+            self.supports_transactions = False
+        if not self.supports_transactions:
+            logger.info("MongoDB has no transactions here; locations and outbox rows are written in sequence")
+
+    def entry(self, location_obj: Location, chat_id: Optional[str] = None) -> dict:
+        now = datetime.now(timezone.utc)
+        return {
+            # Rows have ids of their own: a cleared point may be uploaded again
+            "_id": str(uuid.uuid4()),
+            "location_id": location_obj.id,
+            "chat_id": chat_id or TELEGRAM_CHAT_ID,
+            "device_id": location_obj.device_id,
+            "latitude": location_obj.latitude,
+            "longitude": location_obj.longitude,
+            "timestamp": location_obj.timestamp,
+            "status": "pending",
+            "attempts": 0,
+            # Leased to the dispatcher right away; the poller only steps in if that send is lost
+            "next_attempt_at": datetime.fromtimestamp(now.timestamp() + OUTBOX_LEASE_SECONDS, timezone.utc),
+            "created_at": now,
+        }
+
+    async def insert_with_location(self, location_doc: dict, outbox_doc: dict):
+        """Write a location and its outbox row together"""
+        if self.supports_transactions:
+            async with await client.start_session() as session:
+                async with session.start_transaction():
+                    await insert_location(location_doc, session=session)
+                    await db.telegram_outbox.insert_one(outbox_doc, session=session)
+        else:
+            await insert_location(location_doc)
+            await db.telegram_outbox.insert_one(outbox_doc)
+
+    async def ensure(self, outbox_docs: List[dict], session=None) -> List[dict]:
+        """Write the rows whose location has none yet; returns the ones written
+
+        A retry of a write that stored the location but died before its row
+        lands here, so the point still reaches Telegram.
+        """
+        if not outbox_docs:
+            return []
+        result = await db.telegram_outbox.bulk_write(
+            [UpdateOne({"location_id": doc["location_id"]}, {"$setOnInsert": doc}, upsert=True) for doc in outbox_docs],
+            session=session,
+        )
+        return [outbox_docs[position] for position in result.upserted_ids]
+
+    def dispatch(self, row: dict):
+        """Hand a row's point to the dispatcher"""
+        telegram_dispatcher.enqueue(
+            row["latitude"], row["longitude"], row["chat_id"], row["timestamp"], row["_id"], row.get("device_id"),
+        )
+
+    async def superseded(self, outbox_ids: List[str]):
+        """Retire rows whose point is older than one already delivered"""
+        if not outbox_ids:
+            return
+        await db.telegram_outbox.update_many(
+            {"_id": {"$in": outbox_ids}, "status": "pending"},
+            {"$set": {"status": "superseded", "delivered_at": datetime.now(timezone.utc)}},
+        )
+
+    async def delivered(self, newest: Optional[str], outbox_ids: List[str]):
+        """Mark the row of the sent point delivered and the older ones superseded"""
+        await self.superseded([outbox_id for outbox_id in outbox_ids if outbox_id != newest])
+        if newest is not None:
+            await db.telegram_outbox.update_one(
+                {"_id": newest},
+                {"$set": {"status": "sent", "delivered_at": datetime.now(timezone.utc)}, "$inc": {"attempts": 1}},
+            )
+
+    async def failed(self, newest: Optional[str], outbox_ids: List[str], error: Exception):
+        """Schedule the row of the point that failed for another attempt, or dead-letter it"""
+        if not outbox_ids:
+            return
+        now = datetime.now(timezone.utc)
+        if isinstance(error, CircuitOpenError):
+            # Telegram was never called, so this doesn't count as an attempt
+            next_attempt_at = datetime.fromtimestamp(now.timestamp() + error.retry_in, timezone.utc)
+            await db.telegram_outbox.update_many(
+                {"_id": {"$in": outbox_ids}, "status": "pending"},
+                {"$set": {"next_attempt_at": next_attempt_at}},
+            )
+            return
+        await self.superseded([outbox_id for outbox_id in outbox_ids if outbox_id != newest])
+        if newest is None:
+            return
+        row = await db.telegram_outbox.find_one_and_update(
+            {"_id": newest},
+            {"$inc": {"attempts": 1}, "$set": {"last_error": str(error)}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if row is None:
+            return
+        if row["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+            self.dead += 1
+            logger.error(f"Giving up on Telegram delivery of {newest} after {row['attempts']} attempts")
+            await db.telegram_outbox.update_one({"_id": newest}, {"$set": {"status": "dead"}})
+            return
+        # Full jitter keeps many failing rows from retrying in lockstep
+        delay = random.uniform(0, min(OUTBOX_MAX_DELAY, OUTBOX_BASE_DELAY * 2 ** row["attempts"]))
+        if isinstance(error, httpx.HTTPStatusError) and error.response.status_code == 429:
+            delay = max(delay, _retry_after(error.response))
+        next_attempt_at = datetime.fromtimestamp(now.timestamp() + delay, timezone.utc)
+        await db.telegram_outbox.update_one({"_id": newest}, {"$set": {"next_attempt_at": next_attempt_at}})
+
+    async def claim_due(self) -> int:
+        """Lease due rows to the dispatcher; returns how many were claimed"""
+        now = datetime.now(timezone.utc)
+        lease_until = datetime.fromtimestamp(now.timestamp() + OUTBOX_LEASE_SECONDS, timezone.utc)
+        due = await db.telegram_outbox.find({"status": "pending", "next_attempt_at": {"$lte": now}}) \
+            .sort("next_attempt_at", 1).limit(OUTBOX_BATCH_SIZE).to_list(OUTBOX_BATCH_SIZE)
+        claimed = 0
+        for row in due:
+            if await self._is_superseded(row):
+                await self.superseded([row["_id"]])
+                continue
+            result = await db.telegram_outbox.update_one(
+                {"_id": row["_id"], "status": "pending", "next_attempt_at": row["next_attempt_at"]},
+                {"$set": {"next_attempt_at": lease_until}},
+            )
+            if result.modified_count:
+                claimed += 1
+                self.dispatch(row)
+        return claimed
+
+    async def _is_superseded(self, row: dict) -> bool:
+        """True if a newer point of the row's device has already reached its chat"""
+        key = (row["chat_id"] or TELEGRAM_CHAT_ID, row.get("device_id") or DEFAULT_DEVICE_ID)
+        if telegram_dispatcher.is_superseded(key, row["timestamp"]):
+            return True
+        # Sent rows outlive restarts, unlike the dispatcher's memory
+        newer = await db.telegram_outbox.find_one(
+            {"chat_id": row["chat_id"], "device_id": row.get("device_id"), "status": "sent",
+             "timestamp": {"$gte": row["timestamp"]}},
+            {"_id": 1},
+        )
+        return newer is not None
+
+    async def run(self):
+        while True:
+            try:
+                while await self.claim_due() == OUTBOX_BATCH_SIZE:
+                    pass
+            except Exception as e:
+                logger.error(f"Telegram outbox poll failed: {e}")
+            await asyncio.sleep(OUTBOX_POLL_SECONDS)
+
+    async def stats(self) -> dict:
+        counts = {"pending": 0, "sent": 0, "superseded": 0, "dead": 0}
+        async for row in db.telegram_outbox.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}]):
+            counts[row["_id"]] = row["count"]
+        return counts
+
+
+telegram_outbox = TelegramOutbox()
+
+
+# Cursors
+def _parse_iso_timestamp(value: str) -> datetime:
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def encode_cursor(timestamp: datetime, location_id: str) -> str:
+    """Opaque position in the timestamp/id ordering of locations"""
+    # Mongo keeps millisecond precision, so cursors must not be finer than that
+    timestamp = timestamp.replace(microsecond=timestamp.microsecond // 1000 * 1000)
+    raw = f"{timestamp.isoformat()}|{location_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        timestamp, location_id = base64.urlsafe_b64decode(padded.encode()).decode().split("|", 1)
+        return _parse_iso_timestamp(timestamp), location_id
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def _cursor_filter(timestamp: datetime, location_id: str, newer: bool) -> dict:
+    """Locations strictly newer (or older) than the cursor in timestamp/id order"""
+    op = "$gt" if newer else "$lt"
+    return {"$or": [
+        {"timestamp": {op: timestamp}},
+        {"timestamp": timestamp, "id": {op: location_id}},
+    ]}
+
+
+def _as_utc(value: Optional[datetime]) -> Optional[datetime]:
+    if value is not None and value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+NEWEST_FIRST = [("timestamp", DESCENDING), ("id", DESCENDING)]
+OLDEST_FIRST = [("timestamp", ASCENDING), ("id", ASCENDING)]
+
+
+async def _query_locations(
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    after: Optional[tuple] = None,
+    limit: int = LOCATIONS_PAGE_SIZE,
+    newer_than: Optional[tuple] = None,
+    device_id: Optional[str] = None,
+    session_id: Optional[str] = None,
+    resolution: Optional[str] = None,
+) -> List[dict]:
+    """One keyset page of locations, newest first
+
+    With newer_than the page holds the points closest after that cursor, so a
+    client catching up never skips any. A resolution reads its rollup instead
+    of the stored points.
+    """
+    if resolution is not None:
+        collection = db[f"locations_{resolution}"]
+    elif BUCKET_STORAGE:
+        return await _query_buckets(since, until, after, limit, newer_than, device_id, session_id)
+    else:
+        collection = db.locations
+    query = _location_query(since, until, after, newer_than, device_id, session_id)
+    if newer_than is not None:
+        docs = await collection.find(query, {"_id": 0}).sort(OLDEST_FIRST).limit(limit).to_list(limit)
+        docs.reverse()
+        return docs
+    return await collection.find(query, {"_id": 0}).sort(NEWEST_FIRST).limit(limit).to_list(limit)
+
+
+def _location_query(
+    since: Optional[datetime],
+    until: Optional[datetime],
+    after: Optional[tuple],
+    newer_than: Optional[tuple],
+    device_id: Optional[str],
+    session_id: Optional[str],
+) -> dict:
+    clauses = []
+    # Equality on device_id first lets the device/timestamp/id index serve the sort
+    if device_id is not None:
+        clauses.append({"device_id": device_id})
+    if session_id is not None:
+        # Repeating the partial filter lets the planner pick the session index
+        clauses.extend([{"session_id": session_id}, HAS_SESSION])
+    if since is not None or until is not None:
+        window = {}
+        if since is not None:
+            window["$gte"] = since
+        if until is not None:
+            window["$lt"] = until
+        clauses.append({"timestamp": window})
+    if after is not None:
+        clauses.append(_cursor_filter(*after, newer=False))
+    if newer_than is not None:
+        clauses.append(_cursor_filter(*newer_than, newer=True))
+    return {"$and": clauses} if len(clauses) > 1 else (clauses[0] if clauses else {})
+
+
+async def _choose_resolution(since: datetime, until: Optional[datetime], limit: int, device_id: Optional[str]) -> str:
+    """Finest resolution holding at most limit points between since and until"""
+    query = _location_query(since, until, None, None, device_id, None)
+    if BUCKET_STORAGE:
+        stored = len(await _query_locations(since, until, limit=limit + 1, device_id=device_id))
+    else:
+        stored = await db.locations.count_documents(query, limit=limit + 1)
+    if stored <= limit:
+        return "raw"
+    for name, _, _ in ROLLUPS[:-1]:
+        # Counting stops at limit + 1, so a long range costs no more than a page
+        if await db[f"locations_{name}"].count_documents(query, limit=limit + 1) <= limit:
+            return name
+    return ROLLUPS[-1][0]
+
+
+async def _location_cursor(location_id: str) -> Optional[tuple]:
+    """Cursor position of a stored location, or None if it doesn't exist"""
+    doc = await find_location(location_id)
+    if doc is None:
+        return None
+    return doc["timestamp"], doc["id"]
+
+
+# Bucketed storage
+def _window_start(timestamp: datetime, seconds: int) -> datetime:
+    return datetime.fromtimestamp(int(timestamp.timestamp()) // seconds * seconds, timezone.utc)
+
+
+def _bucket_start(timestamp: datetime) -> datetime:
+    return _window_start(timestamp, LOCATION_BUCKET_SECONDS)
+
+
+def _bucket_update(docs: List[dict]) -> UpdateOne:
+    """Upsert appending docs (all from one device and window) to their bucket"""
+    first = docs[0]
+    start = _bucket_start(first["timestamp"])
+    latitudes = [doc["latitude"] for doc in docs]
+    longitudes = [doc["longitude"] for doc in docs]
+    timestamps = [doc["timestamp"] for doc in docs]
+    return UpdateOne(
+        {"_id": f"{first.get('device_id') or ''}|{start.isoformat()}"},
+        {
+            "$setOnInsert": {"device_id": first.get("device_id"), "start": start},
+            # Parallel arrays: the n-th entry of each belongs to the same point
+            "$push": {
+                "ids": {"$each": [doc["id"] for doc in docs]},
+                "ts": {"$each": timestamps},
+                "lat": {"$each": latitudes},
+                "lon": {"$each": longitudes},
+                "acc": {"$each": [doc.get("accuracy") for doc in docs]},
+                "sessions": {"$each": [doc.get("session_id") for doc in docs]},
+            },
+            "$inc": {"count": len(docs)},
+            "$min": {"min_ts": min(timestamps), "bbox.min_lat": min(latitudes), "bbox.min_lon": min(longitudes)},
+            "$max": {"max_ts": max(timestamps), "bbox.max_lat": max(latitudes), "bbox.max_lon": max(longitudes)},
+        },
+        upsert=True,
+    )
+
+
+def _bucket_groups(docs: List[dict]) -> List[List[int]]:
+    """Positions of docs grouped by the bucket they belong to"""
+    groups: dict = {}
+    for position, doc in enumerate(docs):
+        key = (doc.get("device_id"), _bucket_start(doc["timestamp"]))
+        groups.setdefault(key, []).append(position)
+    return list(groups.values())
+
+
+def _explode_bucket(bucket: dict) -> List[dict]:
+    return [
+        {
+            "id": location_id,
             "latitude": latitude,
-            "longitude": longitude
+            "longitude": longitude,
+            "accuracy": accuracy,
+            "timestamp": timestamp,
+            "device_id": bucket.get("device_id"),
+            "session_id": session_id,
         }
-        response = requests.post(url, json=payload, timeout=10)
-        response.raise_for_status()
-        return response.json()
+        for location_id, latitude, longitude, accuracy, timestamp, session_id in zip(
+            bucket["ids"], bucket["lat"], bucket["lon"], bucket["acc"], bucket["ts"], bucket["sessions"],
+        )
+    ]
+
+
+async def _query_buckets(
+    since: Optional[datetime],
+    until: Optional[datetime],
+    after: Optional[tuple],
+    limit: int,
+    newer_than: Optional[tuple],
+    device_id: Optional[str],
+    session_id: Optional[str],
+) -> List[dict]:
+    """Same page as _query_locations, read from bucket documents"""
+    query: dict = {}
+    if device_id is not None:
+        query["device_id"] = device_id
+    # Coarse bucket-level bounds; points are checked exactly once unpacked
+    if since is not None:
+        query["max_ts"] = {"$gte": since}
+    if newer_than is not None:
+        query.setdefault("max_ts", {})["$gte"] = max(newer_than[0], since or newer_than[0])
+    if until is not None:
+        query["min_ts"] = {"$lt": until}
+    if after is not None:
+        query.setdefault("min_ts", {})["$lte"] = after[0]
+
+    def wanted(point: dict) -> bool:
+        key = (point["timestamp"], point["id"])
+        return ((since is None or point["timestamp"] >= since)
+                and (until is None or point["timestamp"] < until)
+                and (after is None or key < after)
+                and (newer_than is None or key > newer_than)
+                and (session_id is None or point["session_id"] == session_id))
+
+    ascending = newer_than is not None
+    points: List[dict] = []
+    current_start = None
+    # Windows don't overlap, so once a page is full the next window can't contribute
+    async for bucket in db.location_buckets.find(query).sort("start", ASCENDING if ascending else DESCENDING):
+        if bucket["start"] != current_start:
+            if len(points) >= limit:
+                break
+            current_start = bucket["start"]
+        points.extend(point for point in _explode_bucket(bucket) if wanted(point))
+    points.sort(key=lambda point: (point["timestamp"], point["id"]), reverse=not ascending)
+    points = points[:limit]
+    if ascending:
+        points.reverse()
+    return points
+
+
+# Storage
+async def insert_location(doc: dict, session=None):
+    if BUCKET_STORAGE:
+        await db.location_buckets.bulk_write([_bucket_update([doc])], session=session)
+    else:
+        await db.locations.insert_one(doc, session=session)
+
+
+async def insert_locations(docs: List[dict], session=None) -> dict:
+    """Write docs unordered; returns {position: (status, error)} for the ones that failed"""
+    failures = {}
+    if not docs:
+        return failures
+    if BUCKET_STORAGE:
+        groups = _bucket_groups(docs)
+        try:
+            await db.location_buckets.bulk_write(
+                [_bucket_update([docs[position] for position in group]) for group in groups],
+                ordered=False, session=session,
+            )
+        except BulkWriteError as e:
+            for err in e.details.get('writeErrors', []):
+                for position in groups[err['index']]:
+                    failures[position] = ("failed", err.get('errmsg'))
+        return failures
+    try:
+        await db.locations.insert_many(docs, ordered=False, session=session)
+    except BulkWriteError as e:
+        for err in e.details.get('writeErrors', []):
+            # A duplicate id is a point the client already uploaded
+            status = "duplicate" if err.get('code') == 11000 else "failed"
+            failures[err['index']] = (status, err.get('errmsg'))
+    return failures
+
+
+async def find_location(location_id: str) -> Optional[dict]:
+    if BUCKET_STORAGE:
+        bucket = await db.location_buckets.find_one({"ids": location_id})
+        if bucket is None:
+            return None
+        return next((point for point in _explode_bucket(bucket) if point["id"] == location_id), None)
+    return await db.locations.find_one({"id": location_id}, {"_id": 0})
+
+
+async def existing_location_ids(location_ids: List[str]) -> Set[str]:
+    if BUCKET_STORAGE:
+        wanted = set(location_ids)
+        found = set()
+        async for bucket in db.location_buckets.find({"ids": {"$in": location_ids}}, {"ids": 1}):
+            found.update(wanted.intersection(bucket["ids"]))
+        return found
+    return {doc["id"] async for doc in db.locations.find({"id": {"$in": location_ids}}, {"_id": 0, "id": 1})}
+
+
+async def count_locations() -> int:
+    if BUCKET_STORAGE:
+        totals = await db.location_buckets.aggregate([{"$group": {"_id": None, "count": {"$sum": "$count"}}}]).to_list(1)
+        return totals[0]["count"] if totals else 0
+    return await db.locations.estimated_document_count()
+
+
+def _format_sse(location_obj: Location) -> str:
+    data = json.dumps(location_obj.model_dump(mode="json"))
+    return f"id: {encode_cursor(location_obj.timestamp, location_obj.id)}\nevent: location\ndata: {data}\n\n"
+
+
+# History validators
+class HistoryMarker:
+    """In-memory summary of the newest write, used to answer conditional GETs
+
+    Only writes made through this process move the marker, so each worker
+    validates against what it has seen itself. TTL expiry is noticed through
+    the oldest retained document of each served collection, re-read at most
+    once per TTL monitor pass while it is past retention.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self.count = 0
+        self.latest_timestamp: Optional[datetime] = None
+        self.latest_id: Optional[str] = None
+        # collection -> oldest retained value of its TTL field
+        self.oldest: dict = {}
+        self.checked: dict = {}
+
+    async def load(self):
+        self.reset()
+        self.count = await count_locations()
+        newest = await _query_locations(limit=1)
+        if newest:
+            self.latest_timestamp, self.latest_id = newest[0]["timestamp"], newest[0]["id"]
+        for collection, field, _ in _served_retention():
+            self.oldest[collection] = await self._read_oldest(collection, field)
+        self.loaded = True
+
+    @staticmethod
+    async def _read_oldest(collection: str, field: str) -> Optional[datetime]:
+        docs = await db[collection].find({}, {"_id": 0, field: 1}).sort(field, ASCENDING).limit(1).to_list(1)
+        return docs[0].get(field) if docs else None
+
+    async def refresh_expired(self):
+        """Re-read the oldest document of collections the TTL monitor may have trimmed"""
+        if not self.loaded:
+            return
+        now = datetime.now(timezone.utc)
+        for collection, field, seconds in _served_retention():
+            oldest = self.oldest.get(collection)
+            if oldest is None or oldest.timestamp() > now.timestamp() - seconds:
+                continue
+            if time.monotonic() - self.checked.get(collection, float("-inf")) < TTL_MONITOR_SECONDS:
+                continue
+            self.checked[collection] = time.monotonic()
+            self.oldest[collection] = await self._read_oldest(collection, field)
+
+    def record(self, locations: List[Location]):
+        self.count += len(locations)
+        for location_obj in locations:
+            if self.latest_timestamp is None or location_obj.timestamp >= self.latest_timestamp:
+                self.latest_timestamp, self.latest_id = location_obj.timestamp, location_obj.id
+        if locations:
+            # Rollups and buckets keep a later time than their points, so this errs early
+            earliest = min(location_obj.timestamp for location_obj in locations)
+            for collection, _, _ in _served_retention():
+                oldest = self.oldest.get(collection)
+                if oldest is None or earliest < oldest:
+                    self.oldest[collection] = earliest
+
+    def reset(self):
+        self.count = 0
+        self.latest_timestamp = None
+        self.latest_id = None
+        self.oldest = {}
+        self.checked = {}
+
+    def etag(self, variant: str) -> Optional[str]:
+        """Weak ETag for a response shaped by variant (the query string)"""
+        if not self.loaded:
+            return None
+        latest = self.latest_timestamp.isoformat() if self.latest_timestamp else ""
+        oldest = ",".join(
+            f"{collection}={value.isoformat() if value else ''}" for collection, value in sorted(self.oldest.items())
+        )
+        raw = f"{latest}|{self.latest_id}|{self.count}|{oldest}|{variant}"
+        return f'W/"{hashlib.blake2b(raw.encode(), digest_size=12).hexdigest()}"'
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = {tag.strip() for tag in if_none_match.split(",")}
+    # Weak comparison: W/"x" and "x" name the same representation
+    return "*" in candidates or etag in candidates or etag[2:] in candidates
+
+
+history_marker = HistoryMarker()
+
+
+# Ingest filters
+# State key for points sent without a device id
+DEFAULT_DEVICE_ID = "default"
+EARTH_RADIUS_M = 6371008.8
+
+
+def haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great-circle distance between two points in metres"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(1.0, a)))
+
+
+class KalmanFilter:
+    """Streaming constant-velocity Kalman filter over a local east/north plane in metres
+
+    Both axes share one covariance, since fixes report a single radial accuracy.
+    """
+
+    __slots__ = (
+        "origin_lat", "origin_lon", "metres_per_lon", "x", "y", "vx", "vy",
+        "p_pos", "p_cross", "p_vel", "timestamp", "outliers", "last_fix", "last_outlier",
+    )
+
+    # Accuracy assumed for fixes that don't report one
+    DEFAULT_ACCURACY = 50.0
+    MIN_ACCURACY = 1.0
+    METRES_PER_DEGREE = EARTH_RADIUS_M * math.pi / 180
+    # Speed uncertainty (m/s) of a freshly started filter
+    INITIAL_SPEED_SD = 30.0
+
+    def __init__(self):
+        self.timestamp: Optional[datetime] = None
+        self.outliers = 0
+        # Last accepted raw fix, for the implied-speed test
+        self.last_fix: Optional[Location] = None
+        # Last fix rejected as an outlier, so a resend of it isn't counted twice
+        self.last_outlier: Optional[Location] = None
+
+    def _reset(self, location_obj: Location, accuracy: float):
+        self.origin_lat, self.origin_lon = location_obj.latitude, location_obj.longitude
+        self.metres_per_lon = self.METRES_PER_DEGREE * max(0.01, math.cos(math.radians(location_obj.latitude)))
+        self.x = self.y = self.vx = self.vy = 0.0
+        self.p_pos = accuracy * accuracy
+        self.p_cross = 0.0
+        self.p_vel = self.INITIAL_SPEED_SD ** 2
+        self.timestamp = location_obj.timestamp
+        self.outliers = 0
+        self.last_fix = location_obj
+        self.last_outlier = None
+
+    def _is_resend(self, location_obj: Location) -> bool:
+        last = self.last_outlier
+        return last is not None and (
+            last.id == location_obj.id
+            or (last.latitude, last.longitude, last.accuracy)
+            == (location_obj.latitude, location_obj.longitude, location_obj.accuracy)
+        )
+
+    def _to_plane(self, latitude: float, longitude: float) -> tuple:
+        return (longitude - self.origin_lon) * self.metres_per_lon, (latitude - self.origin_lat) * self.METRES_PER_DEGREE
+
+    def update(self, location_obj: Location) -> tuple:
+        """Fold a fix into the estimate
+
+        Returns (rejection reason or None, point to store). Fixes older than the
+        estimate can't be folded in, so they are only checked for accuracy and
+        kept as reported.
+        """
+        accuracy = max(self.MIN_ACCURACY, location_obj.accuracy or self.DEFAULT_ACCURACY)
+        if location_obj.accuracy is not None and location_obj.accuracy > INGEST_MAX_ACCURACY_M:
+            return "inaccurate", location_obj
+        if self.timestamp is None:
+            self._reset(location_obj, accuracy)
+            return None, location_obj
+        if location_obj.timestamp < self.timestamp:
+            return None, location_obj
+
+        last = self.last_fix
+        elapsed = (location_obj.timestamp - last.timestamp).total_seconds()
+        distance = haversine_m(last.latitude, last.longitude, location_obj.latitude, location_obj.longitude)
+        # Movement the two fixes' own uncertainty can explain doesn't count toward speed
+        last_accuracy = max(self.MIN_ACCURACY, last.accuracy or self.DEFAULT_ACCURACY)
+        travelled = max(0.0, distance - accuracy - last_accuracy)
+        if travelled > INGEST_MAX_SPEED_MPS * max(elapsed, 1.0):
+            # A retried or repeated fix is no new evidence that the device moved
+            if self._is_resend(location_obj):
+                return "outlier", location_obj
+            self.outliers += 1
+            self.last_outlier = location_obj
+            if self.outliers < INGEST_MAX_CONSECUTIVE_OUTLIERS:
+                return "outlier", location_obj
+            # Consistently far away: the device really did move, start over from here
+            self._reset(location_obj, accuracy)
+            return None, location_obj
+
+        # Predict: position moves with velocity, uncertainty grows with unmodelled acceleration
+        dt = (location_obj.timestamp - self.timestamp).total_seconds()
+        q = KALMAN_PROCESS_NOISE ** 2
+        self.x += self.vx * dt
+        self.y += self.vy * dt
+        self.p_pos += 2 * dt * self.p_cross + dt * dt * self.p_vel + q * dt ** 4 / 4
+        self.p_cross += dt * self.p_vel + q * dt ** 3 / 2
+        self.p_vel += q * dt * dt
+
+        # Correct with the measured position
+        measured_x, measured_y = self._to_plane(location_obj.latitude, location_obj.longitude)
+        innovation = self.p_pos + accuracy * accuracy
+        gain_pos = self.p_pos / innovation
+        gain_vel = self.p_cross / innovation
+        dx, dy = measured_x - self.x, measured_y - self.y
+        self.x += gain_pos * dx
+        self.y += gain_pos * dy
+        self.vx += gain_vel * dx
+        self.vy += gain_vel * dy
+        self.p_vel -= gain_vel * self.p_cross
+        self.p_cross *= 1 - gain_pos
+        self.p_pos *= 1 - gain_pos
+
+        self.outliers = 0
+        self.last_outlier = None
+        self.timestamp = location_obj.timestamp
+        self.last_fix = location_obj
+        # The device's own accuracy is kept; the estimate only moves the coordinates
+        return None, location_obj.model_copy(update={
+            "latitude": self.origin_lat + self.y / self.METRES_PER_DEGREE,
+            "longitude": self.origin_lon + self.x / self.metres_per_lon,
+        })
+
+
+class DeviceState:
+    """Per-device ingest state kept in memory"""
+
+    __slots__ = ("last_accepted", "speed", "interval_ms", "kalman")
+
+    def __init__(self):
+        self.last_accepted: Optional[Location] = None
+        self.kalman = KalmanFilter()
+        # Metres per second between the last two accepted points
+        self.speed: Optional[float] = None
+        self.interval_ms = REPORT_INTERVAL_DEFAULT_MS
+
+    def accept(self, location_obj: Location):
+        last = self.last_accepted
+        if last is not None:
+            elapsed = (location_obj.timestamp - last.timestamp).total_seconds()
+            if elapsed > 0:
+                distance = haversine_m(last.latitude, last.longitude, location_obj.latitude, location_obj.longitude)
+                self.speed = distance / elapsed
+        self.last_accepted = location_obj
+
+
+device_states = RecentMap()
+
+
+def _device_state(device_id: str) -> DeviceState:
+    state = device_states.get(device_id)
+    if state is None:
+        state = device_states[device_id] = DeviceState()
+    return state
+
+
+def _is_stationary(state: DeviceState, location_obj: Location) -> bool:
+    """True if the point adds nothing over the device's last accepted one"""
+    last = state.last_accepted
+    if last is None or MOVEMENT_MIN_DISTANCE_M <= 0:
+        return False
+    if (location_obj.timestamp - last.timestamp).total_seconds() >= MOVEMENT_MAX_INTERVAL_S:
+        return False
+    # A fix is only as good as its accuracy, so jitter inside it isn't movement
+    accuracy = max(location_obj.accuracy or 0.0, last.accuracy or 0.0)
+    threshold = max(MOVEMENT_MIN_DISTANCE_M, accuracy * MOVEMENT_ACCURACY_FACTOR)
+    distance = haversine_m(last.latitude, last.longitude, location_obj.latitude, location_obj.longitude)
+    return distance <= threshold
+
+
+def recommend_report_interval(state: DeviceState, stationary: bool) -> int:
+    """Milliseconds until the device should report again"""
+    if stationary:
+        # Back off while the device sits still; the first real move resets it
+        interval = state.interval_ms * 2
+    elif state.speed is None or state.speed <= 0:
+        interval = REPORT_INTERVAL_DEFAULT_MS
+    else:
+        # Aim for one report per REPORT_TARGET_DISTANCE_M travelled
+        interval = REPORT_TARGET_DISTANCE_M / state.speed * 1000
+        accuracy = state.last_accepted.accuracy if state.last_accepted else None
+        if accuracy and accuracy > REPORT_TARGET_DISTANCE_M:
+            # Reports closer together than the fix accuracy are mostly noise
+            interval *= accuracy / REPORT_TARGET_DISTANCE_M
+    backlog = telegram_dispatcher.stats()["queue_depth"]
+    interval *= 1 + backlog / REPORT_QUEUE_HIGH_WATER
+    state.interval_ms = int(min(REPORT_INTERVAL_MAX_MS, max(REPORT_INTERVAL_MIN_MS, interval)))
+    return state.interval_ms
+
+
+def _share_result(location_obj: Location, state: DeviceState, stationary: bool = False) -> LocationShareResult:
+    return LocationShareResult(
+        **location_obj.model_dump(),
+        next_report_ms=recommend_report_interval(state, stationary),
+    )
+
+
+# Idempotency
+# Namespace for deriving location ids from Idempotency-Key headers
+IDEMPOTENCY_NAMESPACE = uuid.UUID("8f2b6c1e-4d3a-4f5b-9a7e-2c1d0e9b8a76")
+
+
+class IdempotencyCache(RecentMap):
+    """Recently stored locations keyed by id, counting the retries they answered"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        super().__init__(maxsize, ttl)
+        self.hits = 0
+
+    def get(self, location_id: str, default=None) -> Optional[Location]:
+        location_obj = super().get(location_id, default)
+        if location_obj is not None:
+            self.hits += 1
+        return location_obj
+
+    def put(self, location_obj: Location):
+        self[location_obj.id] = location_obj
+
+
+def _idempotent_id(input: LocationCreate, idempotency_key: Optional[str]) -> Optional[str]:
+    """Location id fixed by the client, if it sent one"""
+    if input.id:
+        return input.id
+    if idempotency_key:
+        return str(uuid.uuid5(IDEMPOTENCY_NAMESPACE, idempotency_key))
+    return None
+
+
+idempotency_cache = IdempotencyCache(IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_TTL_SECONDS)
+
+
+# Live updates
+class LocationBroadcaster:
+    """Fans newly stored locations out to in-process subscribers"""
+
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        # Subscriber queue -> device it follows, or None for every device
+        self._subscribers: dict = {}
+        self.dropped = 0
+
+    def subscribe(self, device_id: Optional[str] = None) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers[queue] = device_id
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.pop(queue, None)
+
+    def publish(self, location: Location):
+        for queue, device_id in self._subscribers.items():
+            if device_id is not None and device_id != location.device_id:
+                continue
+            if queue.full():
+                # A slow subscriber loses its oldest point rather than stalling everyone
+                queue.get_nowait()
+                self.dropped += 1
+            queue.put_nowait(location)
+
+    def __len__(self) -> int:
+        return len(self._subscribers)
+
+
+location_broadcaster = LocationBroadcaster(SUBSCRIBER_QUEUE_SIZE)
+
+
+# Indexes
+# Every point stores session_id, null when it has none, so the session index is
+# partial rather than sparse; only points of a session are indexed
+HAS_SESSION = {"session_id": {"$type": "string"}}
+
+LOCATION_INDEXES = [
+    IndexModel([("timestamp", DESCENDING), ("id", DESCENDING)], name="timestamp_id_desc"),
+    IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    IndexModel([("device_id", ASCENDING), ("timestamp", DESCENDING), ("id", DESCENDING)], name="device_timestamp_id"),
+    IndexModel(
+        [("session_id", ASCENDING), ("timestamp", DESCENDING), ("id", DESCENDING)],
+        name="session_timestamp_id", partialFilterExpression=HAS_SESSION,
+    ),
+]
+
+# Time-series collections take neither unique nor sparse secondary indexes;
+# their buckets are already clustered on device_id and timestamp
+TIMESERIES_LOCATION_INDEXES = [
+    IndexModel([("timestamp", DESCENDING), ("id", DESCENDING)], name="timestamp_id_desc"),
+    IndexModel([("id", ASCENDING)], name="id"),
+    IndexModel([("device_id", ASCENDING), ("timestamp", DESCENDING), ("id", DESCENDING)], name="device_timestamp_id"),
+    IndexModel([("session_id", ASCENDING), ("timestamp", DESCENDING), ("id", DESCENDING)], name="session_timestamp_id"),
+]
+
+OUTBOX_INDEXES = [
+    IndexModel([("status", ASCENDING), ("next_attempt_at", ASCENDING)], name="status_next_attempt"),
+    # Finds the newest delivered point of a device before a retry is sent
+    IndexModel(
+        [("chat_id", ASCENDING), ("device_id", ASCENDING), ("status", ASCENDING), ("timestamp", DESCENDING)],
+        name="chat_device_status_timestamp",
+    ),
+    # Finds the row of a location when a write is retried
+    IndexModel([("location_id", ASCENDING)], name="location_id"),
+    # Delivered rows expire; pending and dead rows have no delivered_at and stay
+    IndexModel([("delivered_at", ASCENDING)], name="delivered_ttl", expireAfterSeconds=OUTBOX_RETENTION_SECONDS),
+]
+
+# Rollups are paged like the stored points, by (timestamp, id)
+ROLLUP_INDEXES = [
+    IndexModel([("device_id", ASCENDING), ("timestamp", DESCENDING), ("id", DESCENDING)], name="device_timestamp_id"),
+    IndexModel([("timestamp", DESCENDING), ("id", DESCENDING)], name="timestamp_id_desc"),
+]
+
+JOB_INDEXES = [
+    IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    # Finished jobs expire; pending and running ones have no finished_at and stay
+    IndexModel([("finished_at", ASCENDING)], name="finished_ttl", expireAfterSeconds=JOB_RETENTION_SECONDS),
+]
+
+BUCKET_INDEXES = [
+    IndexModel([("device_id", ASCENDING), ("start", DESCENDING)], name="device_start"),
+    IndexModel([("start", DESCENDING)], name="start_desc"),
+    # Multikey over the ids array, for replays and since_id lookups
+    IndexModel([("ids", ASCENDING)], name="ids"),
+]
+
+RAW_LOCATION_INDEXES = [
+    IndexModel([("timestamp", DESCENDING)], name="timestamp_desc"),
+]
+
+COLLECTION_INDEXES = {
+    "locations": TIMESERIES_LOCATION_INDEXES if TIMESERIES_STORAGE else LOCATION_INDEXES,
+    "locations_raw": RAW_LOCATION_INDEXES,
+    "telegram_outbox": OUTBOX_INDEXES,
+    "jobs": JOB_INDEXES,
+    **{f"locations_{name}": ROLLUP_INDEXES for name, _, _ in ROLLUPS},
+}
+if BUCKET_STORAGE:
+    COLLECTION_INDEXES["location_buckets"] = BUCKET_INDEXES
+
+# Server error codes for an index that clashes with an existing definition
+INDEX_CONFLICT_CODES = {85, 86}
+
+
+async def _report_index_progress(collection: str, stop: asyncio.Event):
+    """Log progress of in-flight index builds until stop is set"""
+    pipeline = [
+        {"$currentOp": {"allUsers": True, "idleConnections": False}},
+        {"$match": {"command.createIndexes": collection}},
+    ]
+    while not stop.is_set():
+        try:
+            async for op in client.admin.aggregate(pipeline):
+                progress = op.get("progress") or {}
+                if progress.get("total"):
+                    logger.info(f"Index build on {collection}: {op.get('msg', '')} "
+                                f"({progress.get('done')}/{progress.get('total')})")
+        except OperationFailure:
+            # Not every deployment grants $currentOp; the start/finish logs still apply
+            return
+        try:
+            await asyncio.wait_for(stop.wait(), 2)
+        except asyncio.TimeoutError:
+            pass
+
+
+# Before MongoDB 7.0, deletes on a time-series collection may only filter on its metaField
+timeseries_filtered_deletes = False
+
+
+async def ensure_locations_collection():
+    """Create db.locations as a time-series collection when that storage is selected"""
+    global timeseries_filtered_deletes
+    if not TIMESERIES_STORAGE:
+        return
+    info = await client.admin.command("buildInfo")
+    timeseries_filtered_deletes = tuple(info.get("versionArray", [0])[:2]) >= (7, 0)
+    if not timeseries_filtered_deletes:
+        logger.info(f"MongoDB {info.get('version')} deletes time-series points only by device_id")
+    cursor = await db.list_collections(filter={"name": "locations"})
+    existing = await cursor.to_list(1)
+    if existing:
+        if "timeseries" not in existing[0].get("options", {}):
+            raise RuntimeError(
+                "LOCATION_STORAGE=timeseries but locations is a regular collection; "
+                "migrate or rename it before switching storage"
+            )
+        return
+    logger.info("Creating locations as a time-series collection")
+    await db.create_collection("locations", timeseries={
+        "timeField": "timestamp",
+        "metaField": "device_id",
+        "granularity": "seconds",
+    })
+
+
+async def ensure_indexes():
+    """Declare the indexes of every collection, failing fast if one conflicts"""
+    for collection, indexes in COLLECTION_INDEXES.items():
+        total = len(indexes)
+        stop = asyncio.Event()
+        reporter = asyncio.create_task(_report_index_progress(collection, stop))
+        try:
+            for n, index in enumerate(indexes, start=1):
+                name = index.document["name"]
+                started = time.monotonic()
+                logger.info(f"Ensuring index {name} on {collection} ({n}/{total})")
+                try:
+                    await db[collection].create_indexes([index])
+                except DuplicateKeyError as e:
+                    raise RuntimeError(f"Cannot build unique index {name}: duplicate keys in {collection} ({e})") from e
+                except OperationFailure as e:
+                    if e.code in INDEX_CONFLICT_CODES:
+                        raise RuntimeError(f"Index {name} conflicts with an existing index on {collection}: {e}") from e
+                    raise
+                logger.info(f"Index {name} ready in {time.monotonic() - started:.2f}s")
+        finally:
+            stop.set()
+            await reporter
+
+
+# Retention
+def _retention_policies() -> List[tuple]:
+    """(collection, date field, seconds to keep) for every TTL-managed collection"""
+    location_seconds = int(LOCATION_RETENTION_DAYS * 86400)
+    policies = [("locations_raw", "timestamp", location_seconds)]
+    policies.extend((f"locations_{name}", "timestamp", int(days * 86400)) for name, _, days in ROLLUPS)
+    if BUCKET_STORAGE:
+        # A bucket goes once its newest point is past retention
+        policies.append(("location_buckets", "max_ts", location_seconds))
+    elif not TIMESERIES_STORAGE:
+        policies.append(("locations", "timestamp", location_seconds))
+    return policies
+
+
+def _served_retention() -> List[tuple]:
+    """Retention policies of the collections GET /api/locations reads"""
+    policies = [policy for policy in _retention_policies() if policy[0] != "locations_raw" and policy[2]]
+    if TIMESERIES_STORAGE and LOCATION_RETENTION_DAYS:
+        policies.append(("locations", "timestamp", int(LOCATION_RETENTION_DAYS * 86400)))
+    return policies
+
+
+async def ensure_retention():
+    """Bring TTL indexes (and time-series expiry) in line with the retention settings"""
+    if TIMESERIES_STORAGE:
+        seconds = int(LOCATION_RETENTION_DAYS * 86400)
+        await db.command({"collMod": "locations", "expireAfterSeconds": seconds or "off"})
+        logger.info(f"Time-series retention on locations: {seconds or 'off'}")
+    for collection, field, seconds in _retention_policies():
+        name = f"{field}_ttl"
+        existing = (await db[collection].index_information()).get(name)
+        if not seconds:
+            if existing is not None:
+                logger.info(f"Dropping TTL index {name} on {collection}")
+                await db[collection].drop_index(name)
+            continue
+        if existing is None:
+            logger.info(f"Creating TTL index {name} on {collection} ({seconds}s)")
+            await db[collection].create_indexes([IndexModel([(field, ASCENDING)], name=name, expireAfterSeconds=seconds)])
+        elif existing.get("expireAfterSeconds") != seconds:
+            # collMod changes the expiry in place instead of rebuilding the index
+            logger.info(f"Changing TTL index {name} on {collection} to {seconds}s")
+            await db.command({"collMod": collection, "index": {"name": name, "expireAfterSeconds": seconds}})
+
+
+# Rollups
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _rollup_id(device_id: Optional[str], start: datetime) -> str:
+    return f"{device_id or ''}|{start.isoformat()}"
+
+
+async def update_rollups(locations: List[Location]):
+    """Fold newly stored points into every rollup, keeping each window's latest point"""
+    windows: dict = {}
+    for location_obj in locations:
+        doc = location_obj.model_dump()
+        for name, seconds, _ in ROLLUPS:
+            start = _window_start(doc["timestamp"], seconds)
+            window = windows.get((name, doc["device_id"], start))
+            if window is None:
+                windows[(name, doc["device_id"], start)] = {**doc, "start": start, "count": 1}
+                continue
+            window["count"] += 1
+            if (doc["timestamp"], doc["id"]) > (window["timestamp"], window["id"]):
+                window.update(doc)
+    ops: dict = {}
+    for (name, device_id, start), window in windows.items():
+        count = window.pop("count")
+        rollup_id = _rollup_id(device_id, start)
+        ops.setdefault(name, []).extend([
+            UpdateOne({"_id": rollup_id}, {"$setOnInsert": window, "$inc": {"count": count}}, upsert=True),
+            # Only a newer point replaces the one a window already keeps
+            UpdateOne({"_id": rollup_id, "timestamp": {"$lt": window["timestamp"]}}, {"$set": window}),
+        ])
+    try:
+        await asyncio.gather(*(db[f"locations_{name}"].bulk_write(batch) for name, batch in ops.items()))
     except Exception as e:
-        logger.error(f"Failed to send location to Telegram: {e}")
-        raise HTTPException(status_code=500, detail=f"Failed to send to Telegram: {str(e)}")
+        # run_rollups recomputes recent windows, so a miss here heals on its next pass
+        logger.error(f"Failed to update location rollups: {e}")
+
+
+async def rollup_windows(since: datetime, until: datetime) -> int:
+    """Recompute every rollup window in [since, until) from the stored points"""
+    windows: dict = {}
+    written = 0
+
+    async def flush(keys):
+        nonlocal written
+        ops: dict = {}
+        for key in keys:
+            name, device_id, start = key
+            ops.setdefault(name, []).append(
+                UpdateOne({"_id": _rollup_id(device_id, start)}, {"$set": windows.pop(key)}, upsert=True)
+            )
+        for name, batch in ops.items():
+            await db[f"locations_{name}"].bulk_write(batch, ordered=False)
+            written += len(batch)
+
+    after = None
+    while True:
+        # Newest first, so the first point seen in a window is the one it keeps
+        page = await _query_locations(since, until, after, ROLLUP_BATCH_SIZE)
+        for doc in page:
+            for name, seconds, _ in ROLLUPS:
+                key = (name, doc.get("device_id"), _window_start(doc["timestamp"], seconds))
+                if key in windows:
+                    windows[key]["count"] += 1
+                else:
+                    windows[key] = {**doc, "start": key[2], "count": 1}
+        if len(page) < ROLLUP_BATCH_SIZE:
+            break
+        last = page[-1]
+        # Every later point is at or before last, so newer windows are complete
+        boundaries = {name: _window_start(last["timestamp"], seconds) for name, seconds, _ in ROLLUPS}
+        await flush([key for key in windows if key[2] > boundaries[key[0]]])
+        after = (last["timestamp"], last["id"])
+    await flush(list(windows))
+    return written
+
+
+async def run_rollups():
+    """Recompute completed rollup windows every ROLLUP_INTERVAL_SECONDS
+
+    Inserts keep the rollups current; this pass backfills history stored before
+    they existed and repairs windows an insert failed to update.
+    """
+    job_id = "location_rollups"
+    # Whole windows of the coarsest resolution are whole windows of every resolution
+    seconds = ROLLUPS[-1][1]
+    while True:
+        try:
+            state = await db.migrations.find_one({"_id": job_id}) or {}
+            now = datetime.now(timezone.utc)
+            until = _window_start(now, seconds)
+            since = EPOCH
+            if state.get("through") is not None:
+                # Recompute recent windows too, for points uploaded late through /locations/batch
+                since = _window_start(min(state["through"], now - timedelta(seconds=ROLLUP_LOOKBACK_SECONDS)), seconds)
+            if since < until:
+                started = time.monotonic()
+                written = await rollup_windows(since, until)
+                await db.migrations.update_one({"_id": job_id}, {"$set": {"through": until}}, upsert=True)
+                logger.info(f"Rolled up {written} windows up to {until.isoformat()} in {time.monotonic() - started:.2f}s")
+        except Exception as e:
+            logger.error(f"Location rollup failed: {e}")
+        await asyncio.sleep(ROLLUP_INTERVAL_SECONDS)
+
+
+# Migrations
+async def migrate_string_timestamps():
+    """Convert legacy ISO string timestamps to native dates in resumable batches"""
+    if not UNIQUE_LOCATION_IDS:
+        # Time-series and bucket storage only ever hold native dates
+        return
+    migration_id = "locations_timestamp_to_date"
+    state = await db.migrations.find_one({"_id": migration_id}) or {}
+    if state.get("done"):
+        return
+    last_id = state.get("last_id")
+    converted = state.get("converted", 0)
+    logger.info(f"Starting timestamp migration ({converted} documents already converted)")
+
+    while True:
+        query = {"timestamp": {"$type": "string"}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        docs = await db.locations.find(query, {"timestamp": 1}).sort("_id", 1).to_list(MIGRATION_BATCH_SIZE)
+        if not docs:
+            break
+        ops = []
+        for doc in docs:
+            try:
+                parsed = _parse_iso_timestamp(doc["timestamp"])
+            except ValueError:
+                logger.warning(f"Skipping location {doc['_id']} with unparseable timestamp {doc['timestamp']!r}")
+                continue
+            # Match on the old value so a concurrent rewrite is never clobbered
+            ops.append(UpdateOne({"_id": doc["_id"], "timestamp": doc["timestamp"]}, {"$set": {"timestamp": parsed}}))
+        if ops:
+            result = await db.locations.bulk_write(ops, ordered=False)
+            converted += result.modified_count
+        last_id = docs[-1]["_id"]
+        await db.migrations.update_one(
+            {"_id": migration_id},
+            {"$set": {"last_id": last_id, "converted": converted}},
+            upsert=True,
+        )
+
+    await db.migrations.update_one(
+        {"_id": migration_id},
+        {"$set": {"done": True, "converted": converted, "finished_at": datetime.now(timezone.utc)}},
+        upsert=True,
+    )
+    logger.info(f"Timestamp migration finished, {converted} documents converted")
+
+
+background_tasks: List[asyncio.Task] = []
+
+
+# Jobs
+async def _save_job(job: Job, **changes):
+    for field, value in changes.items():
+        setattr(job, field, value)
+    await db.jobs.update_one({"id": job.id}, {"$set": changes})
+
+
+async def _run_job(job: Job, work):
+    await _save_job(job, status="running")
+    try:
+        await work(job)
+    except asyncio.CancelledError:
+        await _save_job(job, status="failed", error="Interrupted by shutdown", finished_at=datetime.now(timezone.utc))
+        raise
+    except Exception as e:
+        logger.error(f"Job {job.id} ({job.type}) failed: {e}")
+        await _save_job(job, status="failed", error=str(e), finished_at=datetime.now(timezone.utc))
+    else:
+        logger.info(f"Job {job.id} ({job.type}) finished, {job.processed} processed")
+        await _save_job(job, status="done", finished_at=datetime.now(timezone.utc))
+
+
+async def start_job(job_type: str, work, params: dict) -> Job:
+    """Record a job and run work(job) in the background"""
+    job = Job(type=job_type, params=params)
+    await db.jobs.insert_one(job.model_dump())
+    task = asyncio.create_task(_run_job(job, work), name=f"job-{job.id}")
+    background_tasks.append(task)
+    task.add_done_callback(background_tasks.remove)
+    return job
+
+
+async def _delete_in_batches(collection: str, query: dict, job: Optional[Job] = None) -> int:
+    """Delete matching documents in _id ranges of DELETE_BATCH_SIZE, pausing between ranges
+
+    Returns the number of points removed; a bucket counts for the points it held.
+    """
+    deleted = 0
+    last_id = None
+    while True:
+        batch_query = query if last_id is None else {"$and": [query, {"_id": {"$gt": last_id}}]}
+        docs = await db[collection].find(batch_query, {"_id": 1, "count": 1}) \
+            .sort("_id", ASCENDING).limit(DELETE_BATCH_SIZE).to_list(DELETE_BATCH_SIZE)
+        if not docs:
+            return deleted
+        first_id, last_id = docs[0]["_id"], docs[-1]["_id"]
+        result = await db[collection].delete_many({"$and": [query, {"_id": {"$gte": first_id, "$lte": last_id}}]})
+        deleted += sum(doc.get("count", 1) for doc in docs) if collection == "location_buckets" else result.deleted_count
+        if job is not None:
+            await _save_job(job, processed=deleted)
+        # Give replication and the cache room to keep up
+        await asyncio.sleep(DELETE_BATCH_PAUSE_SECONDS)
+
+
+async def _delete_by_device(device_id: Optional[str], job: Job) -> int:
+    """Delete time-series points one device at a time, filtering on the metaField only"""
+    device_ids = [device_id] if device_id is not None else await db.locations.distinct("device_id")
+    if device_id is None and None not in device_ids:
+        # Points shared without a device id
+        device_ids.append(None)
+    deleted = 0
+    for device in device_ids:
+        deleted += (await db.locations.delete_many({"device_id": device})).deleted_count
+        await _save_job(job, processed=deleted)
+        await asyncio.sleep(DELETE_BATCH_PAUSE_SECONDS)
+    return deleted
+
+
+async def _swap_in_empty(collection: str):
+    """Replace a collection by an empty one that already carries its indexes
+
+    The rename is atomic, so writes never land in a collection missing its
+    unique index.
+    """
+    staging = db[f"{collection}_clearing"]
+    await staging.drop()
+    await staging.create_indexes(COLLECTION_INDEXES[collection])
+    await staging.rename(collection, dropTarget=True)
+
+
+async def clear_locations_job(job: Job):
+    device_id = job.params.get("device_id")
+    until = job.params.get("until")
+    primary = "location_buckets" if BUCKET_STORAGE else "locations"
+    try:
+        if device_id is None and until is None:
+            # Swapping in an empty collection is far cheaper than deleting every document
+            for collection in ("locations_raw", *(f"locations_{name}" for name, _, _ in ROLLUPS)):
+                await _swap_in_empty(collection)
+            if TIMESERIES_STORAGE:
+                # Time-series collections can't be renamed, and dropping one lets a concurrent
+                # write recreate it as a regular collection
+                if timeseries_filtered_deletes:
+                    await _delete_in_batches(primary, {}, job)
+                else:
+                    await _delete_by_device(None, job)
+            else:
+                await _save_job(job, processed=await count_locations())
+                await _swap_in_empty(primary)
+            await ensure_retention()
+        else:
+            def location_filter(time_field: str) -> dict:
+                query = {}
+                if device_id is not None:
+                    query["device_id"] = device_id
+                if until is not None:
+                    query[time_field] = {"$lt": until}
+                return query
+
+            if TIMESERIES_STORAGE and not timeseries_filtered_deletes:
+                # clear_locations turns away until on these servers
+                await _delete_by_device(device_id, job)
+            else:
+                # Only buckets entirely before until are removed
+                await _delete_in_batches(primary, location_filter("max_ts" if BUCKET_STORAGE else "timestamp"), job)
+            await _delete_in_batches("locations_raw", location_filter("timestamp"))
+            for name, _, _ in ROLLUPS:
+                await _delete_in_batches(f"locations_{name}", location_filter("timestamp"))
+    finally:
+        # Even a failed job must turn ETags back on
+        await history_marker.load()
+        idempotency_cache.clear()
+        if until is None:
+            if device_id is None:
+                device_states.clear()
+            else:
+                device_states.pop(device_id, None)
 
 
 # Routes
@@ -70,40 +2067,397 @@ def send_location_to_telegram(latitude: float, longitude: float):
 async def root():
     return {"message": "Location Sharing API"}
 
-@api_router.post("/location/share", response_model=Location)
-async def share_location(input: LocationCreate):
-    """Save location to database and send to Telegram"""
-    location_obj = Location(**input.model_dump())
+async def _announce(locations: List[Location]):
+    """Move validators, rollups and live listeners on to freshly stored points"""
+    if not locations:
+        return
+    history_marker.record(locations)
+    await update_rollups(locations)
+    for location_obj in sorted(locations, key=lambda loc: loc.timestamp):
+        location_broadcaster.publish(location_obj)
+
+
+async def _resume_delivery(location_obj: Location):
+    """Finish a retried share whose first attempt stored the point but not its outbox row"""
+    inserted = await telegram_outbox.ensure([telegram_outbox.entry(location_obj)])
+    if inserted:
+        await _announce([location_obj])
+        telegram_outbox.dispatch(inserted[0])
+
+@api_router.post("/location/share", response_model=LocationShareResult)
+async def share_location(
+    input: LocationCreate,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None),
+):
+    """Save location to database and send to Telegram
+
+    Fixes are run through the device's Kalman filter first and outliers are
+    rejected. Points that barely moved since the device's last stored one are
+    not stored either; the response is then that last point with
+    X-Location-Suppressed.
+    Every response carries the interval the client should report at next.
+    """
+    state = _device_state(input.device_id or DEFAULT_DEVICE_ID)
+    location_id = _idempotent_id(input, idempotency_key)
+    if location_id is not None:
+        # A retry of a point we already stored: answer from memory
+        replay = idempotency_cache.get(location_id)
+        if replay is not None:
+            return _share_result(replay, state)
+        if not UNIQUE_LOCATION_IDS:
+            # Without a unique index nothing else would catch the retry
+            existing = await find_location(location_id)
+            if existing is not None:
+                replay = Location(**existing)
+                await _resume_delivery(replay)
+                idempotency_cache.put(replay)
+                return _share_result(replay, state)
+    
+    data = input.model_dump(exclude_none=True)
+    if location_id is not None:
+        data['id'] = location_id
+    raw_obj = Location(**data)
     
-    # Convert to dict and serialize datetime to ISO string for MongoDB
+    # Only the cleaned point is stored and forwarded
+    rejected, location_obj = state.kalman.update(raw_obj)
+    if INGEST_STORE_RAW:
+        await db.locations_raw.insert_one({**raw_obj.model_dump(), "rejected": rejected})
+    if rejected is not None:
+        response.headers["X-Location-Suppressed"] = rejected
+        return _share_result(state.last_accepted or raw_obj, state, stationary=True)
+    
+    if _is_stationary(state, location_obj):
+        response.headers["X-Location-Suppressed"] = "stationary"
+        return _share_result(state.last_accepted, state, stationary=True)
+    
+    # Timestamps are stored as native BSON dates
     doc = location_obj.model_dump()
-    doc['timestamp'] = doc['timestamp'].isoformat()
     
-    # Save to database
-    await db.locations.insert_one(doc)
+    # Save to database together with its Telegram outbox row
+    outbox_doc = telegram_outbox.entry(location_obj)
+    try:
+        await telegram_outbox.insert_with_location(doc, outbox_doc)
+    except DuplicateKeyError:
+        # The unique id index caught a retry that outlived the cache
+        existing = await find_location(location_obj.id)
+        if existing is None:
+            raise
+        location_obj = Location(**existing)
+        await _resume_delivery(location_obj)
+        idempotency_cache.put(location_obj)
+        return _share_result(location_obj, state)
+    if location_id is not None:
+        idempotency_cache.put(location_obj)
+    state.accept(location_obj)
     
-    # Send to Telegram
-    send_location_to_telegram(input.latitude, input.longitude)
+    await _announce([location_obj])
     
-    return location_obj
+    # Hand off to the background Telegram workers
+    telegram_outbox.dispatch(outbox_doc)
+    
+    return _share_result(location_obj, state)
+
+@api_router.post("/locations/batch", response_model=LocationBatchResult)
+async def share_location_batch(items: List[Any] = Body(...)):
+    """Save a batch of buffered locations with a single insert"""
+    if len(items) > LOCATION_BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"Batch exceeds {LOCATION_BATCH_MAX} locations")
+
+    results = [LocationBatchItemResult(index=i, status="created") for i in range(len(items))]
+    locations = []
+    indexes = []
+    for i, item in enumerate(items):
+        try:
+            parsed = LocationBatchItem.model_validate(item)
+        except ValidationError as e:
+            results[i].status = "invalid"
+            results[i].error = "; ".join(f"{'.'.join(str(p) for p in err['loc'])}: {err['msg']}" for err in e.errors())
+            continue
+        data = parsed.model_dump(exclude_none=True)
+        location_obj = Location(**data)
+        results[i].id = location_obj.id
+        locations.append(location_obj)
+        indexes.append(i)
+
+    valid = list(zip(locations, indexes))
+    already_stored: Set[str] = set()
+
+    # An id repeated within the batch is stored once; no index would catch it in every storage
+    seen_ids: Set[str] = set()
+    kept = []
+    for location_obj, i in zip(locations, indexes):
+        if location_obj.id in seen_ids:
+            results[i].status = "duplicate"
+        else:
+            seen_ids.add(location_obj.id)
+            kept.append((location_obj, i))
+    locations = [location_obj for location_obj, _ in kept]
+    indexes = [i for _, i in kept]
+
+    if locations and (not UNIQUE_LOCATION_IDS or telegram_outbox.supports_transactions):
+        # Without a unique index, or to keep the transaction below from failing on them,
+        # find re-uploaded points up front
+        already_stored = await existing_location_ids([location_obj.id for location_obj in locations])
+        kept = []
+        for location_obj, i in zip(locations, indexes):
+            if location_obj.id in already_stored:
+                results[i].status = "duplicate"
+            else:
+                kept.append((location_obj, i))
+        locations = [location_obj for location_obj, _ in kept]
+        indexes = [i for _, i in kept]
+
+    if locations:
+        # The same filter as share_location, fed in time order
+        kept = []
+        raw_docs = []
+        for location_obj, i in sorted(zip(locations, indexes), key=lambda pair: pair[0].timestamp):
+            state = _device_state(location_obj.device_id or DEFAULT_DEVICE_ID)
+            rejected, cleaned = state.kalman.update(location_obj)
+            if INGEST_STORE_RAW:
+                raw_docs.append({**location_obj.model_dump(), "rejected": rejected})
+            if rejected is not None:
+                results[i].status = "rejected"
+                results[i].error = rejected
+            else:
+                kept.append((cleaned, i))
+        if raw_docs:
+            await db.locations_raw.insert_many(raw_docs)
+        kept.sort(key=lambda pair: pair[1])
+        locations = [location_obj for location_obj, _ in kept]
+        indexes = [i for _, i in kept]
+
+    stored_by_id = {location_obj.id: location_obj for location_obj in locations}
+
+    def outbox_docs() -> List[dict]:
+        # Only the freshest point of each device is worth forwarding to Telegram. Re-uploads
+        # count too: the upload that stored them may have died before writing their rows.
+        latest_by_device = {}
+        for location_obj, i in valid:
+            stored = location_obj.id in stored_by_id or location_obj.id in already_stored
+            if results[i].status not in ("created", "duplicate") or not stored:
+                continue
+            location_obj = stored_by_id.get(location_obj.id, location_obj)
+            latest = latest_by_device.get(location_obj.device_id)
+            if latest is None or location_obj.timestamp >= latest.timestamp:
+                latest_by_device[location_obj.device_id] = location_obj
+        return [telegram_outbox.entry(latest) for latest in latest_by_device.values()]
+
+    docs = [location_obj.model_dump() for location_obj in locations]
+    forwarded = None
+    if docs and telegram_outbox.supports_transactions:
+        async with await client.start_session() as session:
+            async with session.start_transaction():
+                if await insert_locations(docs, session=session):
+                    # Stored by someone else meanwhile; sorted out one by one below
+                    await session.abort_transaction()
+                else:
+                    forwarded = await telegram_outbox.ensure(outbox_docs(), session=session)
+    if forwarded is None:
+        for position, (status, error) in (await insert_locations(docs)).items():
+            result = results[indexes[position]]
+            result.status = status
+            result.error = error
+        forwarded = await telegram_outbox.ensure(outbox_docs())
+
+    created = [locations[n] for n, i in enumerate(indexes) if results[i].status == "created"]
+    duplicates = sum(1 for result in results if result.status == "duplicate")
+    rejected = sum(1 for result in results if result.status == "rejected")
+    await _announce(created)
+    for outbox_doc in forwarded:
+        telegram_outbox.dispatch(outbox_doc)
+
+    return LocationBatchResult(
+        created=len(created),
+        duplicates=duplicates,
+        rejected=rejected,
+        failed=len(items) - len(created) - duplicates - rejected,
+        results=results,
+    )
 
 @api_router.get("/locations", response_model=List[Location])
-async def get_locations():
-    """Get all location history"""
-    locations = await db.locations.find({}, {"_id": 0}).sort("timestamp", -1).to_list(100)
-    
-    # Convert ISO string timestamps back to datetime objects
-    for loc in locations:
-        if isinstance(loc['timestamp'], str):
-            loc['timestamp'] = datetime.fromisoformat(loc['timestamp'])
-    
+async def get_locations(
+    request: Request,
+    response: Response,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    limit: int = Query(LOCATIONS_PAGE_SIZE, ge=1, le=LOCATIONS_PAGE_MAX),
+    after: Optional[str] = None,
+    since_id: Optional[str] = None,
+    device_id: Optional[str] = None,
+    session_id: Optional[str] = None,
+    resolution: str = Query("auto", pattern=f"^({'|'.join(['auto', 'raw', *(name for name, _, _ in ROLLUPS)])})$"),
+):
+    """Get location history, newest first, one page at a time
+
+    since_id returns only points newer than the one the client already has;
+    X-Has-More tells it to ask again from the newest point it received.
+    With a since range, resolution=auto reads the finest rollup whose points
+    fit in limit; X-Resolution says which one was used.
+    """
+    await history_marker.refresh_expired()
+    etag = history_marker.etag(str(sorted(request.query_params.multi_items())))
+    if etag is not None:
+        if _etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "no-cache"
+
+    since, until = _as_utc(since), _as_utc(until)
+    if resolution == "auto":
+        # Catching up and session replays want every point
+        if since is not None and since_id is None and session_id is None:
+            resolution = await _choose_resolution(since, until, limit, device_id)
+        else:
+            resolution = "raw"
+    response.headers["X-Resolution"] = resolution
+    rollup = None if resolution == "raw" else resolution
+
+    if since_id is not None:
+        if after is not None:
+            raise HTTPException(status_code=400, detail="since_id and after cannot be combined")
+        newer_than = await _location_cursor(since_id)
+        if newer_than is None:
+            raise HTTPException(status_code=404, detail="Unknown since_id")
+        locations = await _query_locations(
+            since, until, limit=limit, newer_than=newer_than,
+            device_id=device_id, session_id=session_id, resolution=rollup,
+        )
+        if len(locations) == limit:
+            response.headers["X-Has-More"] = "true"
+        return locations
+
+    cursor = decode_cursor(after) if after else None
+    locations = await _query_locations(
+        since, until, cursor, limit, device_id=device_id, session_id=session_id, resolution=rollup,
+    )
+    if len(locations) == limit:
+        last = locations[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor(last["timestamp"], last["id"])
     return locations
 
-@api_router.delete("/locations")
-async def clear_locations():
-    """Clear all location history"""
-    result = await db.locations.delete_many({})
-    return {"deleted_count": result.deleted_count}
+@api_router.delete("/locations", response_model=Job, status_code=202)
+async def clear_locations(device_id: Optional[str] = None, until: Optional[datetime] = None):
+    """Start clearing location history, optionally only one device's or points before until"""
+    if until is not None and TIMESERIES_STORAGE and not timeseries_filtered_deletes:
+        raise HTTPException(
+            status_code=400, detail="Clearing up to a time needs MongoDB 7.0 or later with time-series storage",
+        )
+    # ETags would go stale while the job runs; they come back once it reloads the marker
+    history_marker.loaded = False
+    return await start_job("clear_locations", clear_locations_job, {"device_id": device_id, "until": _as_utc(until)})
+
+@api_router.get("/jobs/{job_id}", response_model=Job)
+async def get_job(job_id: str):
+    """Status and progress of a background job"""
+    doc = await db.jobs.find_one({"id": job_id}, {"_id": 0})
+    if doc is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return Job(**doc)
+
+@api_router.get("/locations/stream")
+async def stream_locations(
+    request: Request,
+    device_id: Optional[str] = None,
+    last_event_id: Optional[str] = Header(None),
+):
+    """Server-Sent Events stream of newly stored locations"""
+    cursor = decode_cursor(last_event_id) if last_event_id else None
+    queue = location_broadcaster.subscribe(device_id)
+
+    async def events():
+        try:
+            yield "retry: 5000\n\n"
+            replayed: Set[str] = set()
+            if cursor is not None:
+                # Replay what the client missed while it was disconnected
+                missed = await _query_locations(
+                    limit=SSE_BACKFILL_LIMIT, newer_than=cursor, device_id=device_id,
+                )
+                for doc in reversed(missed):
+                    location_obj = Location(**doc)
+                    replayed.add(location_obj.id)
+                    yield _format_sse(location_obj)
+            while not await request.is_disconnected():
+                try:
+                    location_obj = await asyncio.wait_for(queue.get(), SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if location_obj.id in replayed:
+                    continue
+                yield _format_sse(location_obj)
+        finally:
+            location_broadcaster.unsubscribe(queue)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@api_router.websocket("/ws/locations")
+async def locations_websocket(websocket: WebSocket, device_id: Optional[str] = None):
+    """Push newly stored locations to the client as they arrive"""
+    await websocket.accept()
+    # Subscribe before reading the snapshot so nothing falls in between
+    queue = location_broadcaster.subscribe(device_id)
+    try:
+        snapshot = await _query_locations(limit=WS_SNAPSHOT_SIZE, device_id=device_id)
+        await websocket.send_json({
+            "type": "snapshot",
+            "locations": [Location(**doc).model_dump(mode="json") for doc in snapshot],
+        })
+
+        async def forward():
+            while True:
+                location_obj = await queue.get()
+                await websocket.send_json({"type": "location", "location": location_obj.model_dump(mode="json")})
+
+        async def receive():
+            # Clients don't send anything; this only notices the disconnect
+            while True:
+                await websocket.receive_text()
+
+        tasks = [asyncio.create_task(forward()), asyncio.create_task(receive())]
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        for task in done:
+            if not isinstance(task.exception(), WebSocketDisconnect):
+                task.result()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        location_broadcaster.unsubscribe(queue)
+
+@api_router.get("/health")
+async def health():
+    """Liveness of MongoDB and the Telegram circuit"""
+    try:
+        await asyncio.wait_for(client.admin.command("ping"), 2)
+        mongo = "ok"
+    except Exception as e:
+        mongo = f"error: {e}"
+    circuit = telegram_breaker.stats()
+    # An open circuit degrades delivery but ingest keeps working
+    status = "ok" if mongo == "ok" and circuit["state"] == CircuitBreaker.CLOSED else "degraded"
+    if mongo != "ok":
+        status = "error"
+    return {
+        "status": status,
+        "mongo": mongo,
+        "telegram": {
+            "circuit": circuit,
+            "queue_depth": telegram_dispatcher.stats()["queue_depth"],
+        },
+    }
+
+@api_router.get("/telegram/stats")
+async def telegram_stats():
+    """Telegram dispatch queue depth, drain latency and outbox state"""
+    return {**telegram_dispatcher.stats(), "outbox": await telegram_outbox.stats()}
 
 
 # Include the router in the main app
@@ -115,6 +2469,7 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor", "X-Has-More", "X-Location-Suppressed", "X-Resolution"],
 )
 
 # Configure logging
@@ -124,6 +2479,27 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def start_telegram_dispatcher():
+    await telegram_client.start()
+    await telegram_dispatcher.start()
+
+@app.on_event("startup")
+async def prepare_database():
+    await ensure_locations_collection()
+    await ensure_indexes()
+    await ensure_retention()
+    await history_marker.load()
+    await telegram_outbox.detect_transactions()
+    background_tasks.append(asyncio.create_task(telegram_outbox.run(), name="telegram-outbox"))
+    background_tasks.append(asyncio.create_task(migrate_string_timestamps(), name="timestamp-migration"))
+    background_tasks.append(asyncio.create_task(run_rollups(), name="location-rollups"))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await telegram_dispatcher.stop()
+    await telegram_client.close()
     client.close()
\ No newline at end of file
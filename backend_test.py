@@ -1,8 +1,70 @@
 import requests
 import sys
 import json
-from datetime import datetime
+import os
+import random
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import time
+import uuid
+from websockets.sync.client import connect as websocket_connect
+
+class TelegramStandIn:
+    """Minimal local Bot API; point the backend's TELEGRAM_API_URL at it to test delivery"""
+
+    def __init__(self, port):
+        self.status = 200
+        # latitude -> statuses the next calls carrying it are answered with, in turn
+        self.failures = {}
+        self.calls = []
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b"{}")
+                status = standin.status
+                latitude = payload.get("latitude")
+                if standin.failures.get(latitude):
+                    status = standin.failures[latitude].pop(0)
+                call = {"method": self.path.rsplit('/', 1)[-1], "payload": payload, "status": status, "at": time.time()}
+                standin.calls.append(call)
+                if status == 200:
+                    call["message_id"] = payload.get("message_id", len(standin.calls))
+                    body = {"ok": True, "result": {"message_id": call["message_id"]}}
+                elif status == 429:
+                    body = {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 2",
+                            "parameters": {"retry_after": 2}}
+                else:
+                    body = {"ok": False, "error_code": status, "description": "Stand-in failure"}
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def calls_at(self, latitude, status=None):
+        """Indexes of calls that carried the given latitude, optionally only those answered with status"""
+        return [
+            n for n, call in enumerate(self.calls)
+            if call["payload"].get("latitude") == latitude and (status is None or call["status"] == status)
+        ]
+
+    def wait_for(self, condition, timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if condition():
+                return True
+            time.sleep(0.5)
+        return condition()
+
 
 class LocationSharingAPITester:
     def __init__(self, base_url="https://liveshare-bot.preview.emergentagent.com"):
@@ -11,6 +73,71 @@ class LocationSharingAPITester:
         self.tests_run = 0
         self.tests_passed = 0
         self.test_results = []
+        # Each run writes under its own device ids so earlier runs can't interfere
+        self.run_id = uuid.uuid4().hex[:8]
+        # Delivery tests need the backend started with TELEGRAM_API_URL=http://<this host>:<port>
+        # and short outbox and breaker timings, e.g.
+        # OUTBOX_BASE_DELAY=1 OUTBOX_MAX_ATTEMPTS=2 TELEGRAM_BREAKER_RESET=5
+        port = os.environ.get('TELEGRAM_STANDIN_PORT')
+        self.standin = TelegramStandIn(int(port)) if port else None
+        self.standin_timeout = float(os.environ.get('TELEGRAM_STANDIN_TIMEOUT', '120'))
+
+    def device_id(self, name):
+        """Device id unique to this test run"""
+        return f"test-{self.run_id}-{name}"
+
+    @staticmethod
+    def iso(seconds_ago):
+        """ISO timestamp the given number of seconds in the past"""
+        return datetime.fromtimestamp(time.time() - seconds_ago, timezone.utc).isoformat()
+
+    def upload_track(self, device_id, count, start_seconds_ago=600):
+        """Store count points of a device 5 s and about 20 m apart; returns their ids, oldest first"""
+        items = [
+            {"id": f"{device_id}-{start_seconds_ago}-{n}", "latitude": 28.6139 + n * 0.0002, "longitude": 77.209,
+             "accuracy": 10.0, "device_id": device_id, "timestamp": self.iso(start_seconds_ago - 5 * n)}
+            for n in range(count)
+        ]
+        response = requests.post(f"{self.api_url}/locations/batch", json=items, timeout=15)
+        response.raise_for_status()
+        return [item["id"] for item in items]
+
+    def share_at(self, device_id, latitude, headers=None):
+        """Share a point for a device and return the response"""
+        return requests.post(
+            f"{self.api_url}/location/share",
+            json={"latitude": latitude, "longitude": 77.209, "accuracy": 10.0, "device_id": device_id},
+            headers=headers,
+            timeout=15,
+        )
+
+    def stored_ids(self, device_id):
+        """Ids of the raw points stored for a device, newest first"""
+        response = requests.get(
+            f"{self.api_url}/locations", params={"device_id": device_id, "resolution": "raw"}, timeout=10,
+        )
+        response.raise_for_status()
+        return [loc['id'] for loc in response.json()]
+
+    @staticmethod
+    def next_sse_event(lines):
+        """Fields of the next Server-Sent Event carrying data, skipping comments"""
+        event = {}
+        for line in lines:
+            if not line:
+                if "data" in event:
+                    return event
+                event = {}
+            elif not line.startswith(":"):
+                field, _, value = line.partition(":")
+                event[field] = value[1:] if value.startswith(" ") else value
+        return None
+
+    def skip_without_standin(self, name):
+        if self.standin is None:
+            print(f"⏭️  {name} - SKIPPED (set TELEGRAM_STANDIN_PORT)")
+            return True
+        return False
 
     def log_test(self, name, success, details=""):
         """Log test result"""
@@ -40,6 +167,24 @@ class LocationSharingAPITester:
             self.log_test("API Root Endpoint", False, str(e))
             return False
 
+    def test_health(self):
+        """Test health endpoint"""
+        try:
+            response = requests.get(f"{self.api_url}/health", timeout=10)
+            success = response.status_code == 200
+            if success:
+                data = response.json()
+                state = data.get('telegram', {}).get('circuit', {}).get('state')
+                success = data.get('mongo') == 'ok' and state is not None
+                details = f"Status: {data.get('status')}, Telegram circuit: {state}"
+            else:
+                details = f"Status: {response.status_code}, Response: {response.text[:200]}"
+            self.log_test("Health Endpoint", success, details)
+            return success
+        except Exception as e:
+            self.log_test("Health Endpoint", False, str(e))
+            return False
+
     def test_share_location(self):
         """Test location sharing endpoint"""
         test_location = {
@@ -107,15 +252,494 @@ class LocationSharingAPITester:
             self.log_test("Get Location History", False, str(e))
             return False, []
 
+    def test_paginate_locations(self):
+        """Test walking location history with keyset cursors"""
+        try:
+            seen_ids = []
+            params = {"limit": 2}
+            pages = 0
+            while pages < 5:
+                response = requests.get(f"{self.api_url}/locations", params=params, timeout=10)
+                if response.status_code != 200:
+                    details = f"Status: {response.status_code}, Response: {response.text[:200]}"
+                    self.log_test("Paginate Location History", False, details)
+                    return False
+                data = response.json()
+                pages += 1
+                seen_ids.extend(loc['id'] for loc in data)
+                next_cursor = response.headers.get('X-Next-Cursor')
+                if not next_cursor:
+                    break
+                params = {"limit": 2, "after": next_cursor}
+
+            success = len(seen_ids) == len(set(seen_ids))
+            details = f"Walked {pages} pages, {len(seen_ids)} locations"
+            if not success:
+                details = f"Duplicate locations across pages: {seen_ids}"
+            self.log_test("Paginate Location History", success, details)
+            return success
+
+        except Exception as e:
+            self.log_test("Paginate Location History", False, str(e))
+            return False
+
+    def test_batch_upload(self):
+        """Test batch upload reports a status for every item"""
+        device_id = self.device_id("batch")
+        items = [
+            {"id": f"{device_id}-0", "latitude": 28.6139, "longitude": 77.209, "accuracy": 10.0,
+             "device_id": device_id, "timestamp": self.iso(600)},
+            {"id": f"{device_id}-1", "latitude": 28.6141, "longitude": 77.209, "accuracy": 10.0,
+             "device_id": device_id, "timestamp": self.iso(595)},
+            {"latitude": "north", "longitude": 77.209},
+            # Same id twice in one batch is stored once
+            {"id": f"{device_id}-1", "latitude": 28.6141, "longitude": 77.209, "accuracy": 10.0,
+             "device_id": device_id, "timestamp": self.iso(595)},
+            # A device clock an hour fast must not outrank the device's later shares
+            {"id": f"{device_id}-future", "latitude": 28.6143, "longitude": 77.209, "accuracy": 10.0,
+             "device_id": device_id, "timestamp": self.iso(-3600)},
+        ]
+        try:
+            response = requests.post(f"{self.api_url}/locations/batch", json=items, timeout=15)
+            if response.status_code != 200:
+                details = f"Status: {response.status_code}, Response: {response.text[:200]}"
+                self.log_test("Batch Upload", False, details)
+                return False
+            data = response.json()
+            statuses = [result['status'] for result in data['results']]
+            success = (statuses == ["created", "created", "invalid", "duplicate", "invalid"]
+                       and data['created'] == 2 and data['duplicates'] == 1 and data['failed'] == 2)
+            details = f"Statuses: {statuses}"
+
+            if success:
+                # Re-uploading the same points must not store them again
+                response = requests.post(f"{self.api_url}/locations/batch", json=items[:2], timeout=15)
+                data = response.json()
+                statuses = [result['status'] for result in data['results']]
+                success = response.status_code == 200 and statuses == ["duplicate", "duplicate"]
+                details = f"Re-upload statuses: {statuses}"
+
+            if success:
+                response = requests.get(f"{self.api_url}/locations", params={"device_id": device_id}, timeout=10)
+                stored = sorted(loc['id'] for loc in response.json())
+                success = stored == [f"{device_id}-0", f"{device_id}-1"]
+                details = f"Stored once each: {stored}"
+
+            self.log_test("Batch Upload", success, details)
+            return success
+
+        except Exception as e:
+            self.log_test("Batch Upload", False, str(e))
+            return False
+
+    def test_since_id(self):
+        """Test fetching only points newer than one the client has"""
+        device_id = self.device_id("delta")
+        try:
+            ids = self.upload_track(device_id, 4)
+            params = {"device_id": device_id, "since_id": ids[0]}
+            response = requests.get(f"{self.api_url}/locations", params=params, timeout=10)
+            newer = [loc['id'] for loc in response.json()] if response.status_code == 200 else None
+            success = newer == ids[:0:-1] and 'X-Has-More' not in response.headers
+            details = f"Newer than {ids[0]}: {newer}"
+
+            if success:
+                # A short page says more are waiting and holds the points right after since_id
+                response = requests.get(f"{self.api_url}/locations", params={**params, "limit": 2}, timeout=10)
+                newer = [loc['id'] for loc in response.json()]
+                success = newer == [ids[2], ids[1]] and response.headers.get('X-Has-More') == "true"
+                details = f"Short page: {newer}, X-Has-More: {response.headers.get('X-Has-More')}"
+
+            if success:
+                response = requests.get(
+                    f"{self.api_url}/locations", params={"since_id": f"{device_id}-missing"}, timeout=10,
+                )
+                success = response.status_code == 404
+                details = f"Unknown since_id status: {response.status_code}"
+
+            self.log_test("Delta Since ID", success, details)
+            return success
+
+        except Exception as e:
+            self.log_test("Delta Since ID", False, str(e))
+            return False
+
+    def test_etag(self):
+        """Test conditional history requests answer 304 until something changes"""
+        device_id = self.device_id("etag")
+        try:
+            self.upload_track(device_id, 1)
+            params = {"device_id": device_id}
+            response = requests.get(f"{self.api_url}/locations", params=params, timeout=10)
+            etag = response.headers.get('ETag')
+            success = response.status_code == 200 and etag is not None
+            details = f"ETag: {etag}"
+
+            if success:
+                response = requests.get(
+                    f"{self.api_url}/locations", params=params, headers={'If-None-Match': etag}, timeout=10,
+                )
+                success = response.status_code == 304 and not response.content
+                details = f"Unchanged status: {response.status_code}"
+
+            if success:
+                self.upload_track(device_id, 2, start_seconds_ago=300)
+                response = requests.get(
+                    f"{self.api_url}/locations", params=params, headers={'If-None-Match': etag}, timeout=10,
+                )
+                success = (response.status_code == 200 and response.headers.get('ETag') != etag
+                           and len(response.json()) == 3)
+                details = f"After a write: {response.status_code}, {len(response.content)} bytes"
+
+            self.log_test("History ETag", success, details)
+            return success
+
+        except Exception as e:
+            self.log_test("History ETag", False, str(e))
+            return False
+
+    def test_resolution_auto(self):
+        """Test a long range that doesn't fit in a page is read from a rollup"""
+        device_id = self.device_id("rollup")
+        try:
+            # About 12 minutes of points 5 s apart
+            ids = self.upload_track(device_id, 150, start_seconds_ago=900)
+            params = {"device_id": device_id, "since": self.iso(1000)}
+            response = requests.get(f"{self.api_url}/locations", params={**params, "limit": 20}, timeout=10)
+            resolution = response.headers.get('X-Resolution')
+            points = response.json() if response.status_code == 200 else []
+            success = response.status_code == 200 and resolution in ("1m", "15m", "1h") and 0 < len(points) <= 20
+            details = f"Limit 20: {resolution}, {len(points)} points"
+
+            if success:
+                # When every point fits, they come back as stored
+                response = requests.get(f"{self.api_url}/locations", params={**params, "limit": 500}, timeout=10)
+                resolution = response.headers.get('X-Resolution')
+                points = [loc['id'] for loc in response.json()]
+                success = resolution == "raw" and points == ids[::-1]
+                details = f"Limit 500: {resolution}, {len(points)}/{len(ids)} points"
+
+            self.log_test("Automatic Resolution", success, details)
+            return success
+
+        except Exception as e:
+            self.log_test("Automatic Resolution", False, str(e))
+            return False
+
+    def test_websocket_updates(self):
+        """Test the WebSocket sends a snapshot and then pushes each newly stored point"""
+        device_id = self.device_id("websocket")
+        ws_url = self.api_url.replace("http", "ws", 1)
+        try:
+            self.share_at(device_id, 28.6139).raise_for_status()
+            with websocket_connect(f"{ws_url}/ws/locations?device_id={device_id}", open_timeout=10) as websocket:
+                snapshot = json.loads(websocket.recv(timeout=10))
+                shared = self.share_at(device_id, 28.6143)
+                pushed = json.loads(websocket.recv(timeout=10))
+            success = (
+                snapshot.get("type") == "snapshot" and len(snapshot.get("locations", [])) == 1
+                and pushed.get("type") == "location" and pushed["location"]["id"] == shared.json()["id"]
+            )
+            details = f"Snapshot of {len(snapshot.get('locations', []))}, then {pushed.get('type')}"
+            self.log_test("WebSocket Live Updates", success, details)
+            return success
+
+        except Exception as e:
+            self.log_test("WebSocket Live Updates", False, str(e))
+            return False
+
+    def test_sse_stream(self):
+        """Test the SSE stream delivers new points and replays missed ones on Last-Event-ID"""
+        device_id = self.device_id("sse")
+        url = f"{self.api_url}/locations/stream"
+        params = {"device_id": device_id}
+        try:
+            with requests.get(url, params=params, stream=True, timeout=(10, 30)) as response:
+                lines = response.iter_lines(decode_unicode=True)
+                shared = self.share_at(device_id, 28.6139)
+                event = self.next_sse_event(lines)
+            success = (
+                response.status_code == 200 and event is not None and event.get("event") == "location"
+                and json.loads(event["data"])["id"] == shared.json()["id"]
+            )
+            details = f"Live event: {event}"
+
+            if success:
+                # Shared while the client was away; resuming from the last event id replays it
+                missed = self.share_at(device_id, 28.6143)
+                headers = {"Last-Event-ID": event["id"]}
+                with requests.get(url, params=params, headers=headers, stream=True, timeout=(10, 30)) as response:
+                    replayed = self.next_sse_event(response.iter_lines(decode_unicode=True))
+                success = replayed is not None and json.loads(replayed["data"])["id"] == missed.json()["id"]
+                details = f"Replayed event: {replayed}"
+
+            self.log_test("SSE Stream", success, details)
+            return success
+
+        except Exception as e:
+            self.log_test("SSE Stream", False, str(e))
+            return False
+
+    def test_idempotency_key(self):
+        """Test a share retried with the same Idempotency-Key is stored once"""
+        device_id = self.device_id("idempotent")
+        headers = {"Idempotency-Key": uuid.uuid4().hex}
+        try:
+            first = self.share_at(device_id, 28.6139, headers)
+            retry = self.share_at(device_id, 28.6139, headers)
+            success = first.status_code == 200 and retry.status_code == 200
+            details = f"Status: {first.status_code}, {retry.status_code}"
+
+            if success:
+                stored = self.stored_ids(device_id)
+                success = retry.json()['id'] == first.json()['id'] and stored == [first.json()['id']]
+                details = f"Ids: {first.json()['id']}, {retry.json()['id']}; stored: {stored}"
+
+            self.log_test("Idempotency Key Replay", success, details)
+            return success
+
+        except Exception as e:
+            self.log_test("Idempotency Key Replay", False, str(e))
+            return False
+
+    def test_stationary_suppression(self):
+        """Test a point that barely moved is answered with the last stored one and not stored"""
+        device_id = self.device_id("stationary")
+        try:
+            first = self.share_at(device_id, 28.6139)
+            first.raise_for_status()
+            # About a metre further, well inside the movement threshold
+            response = self.share_at(device_id, 28.61391)
+            suppressed = response.headers.get('X-Location-Suppressed')
+            stored = self.stored_ids(device_id)
+            success = (
+                response.status_code == 200 and suppressed == "stationary"
+                and response.json()['id'] == first.json()['id'] and stored == [first.json()['id']]
+            )
+            details = f"X-Location-Suppressed: {suppressed}, stored: {len(stored)} points"
+            self.log_test("Stationary Suppression", success, details)
+            return success
+
+        except Exception as e:
+            self.log_test("Stationary Suppression", False, str(e))
+            return False
+
+    def test_outlier_rejection(self):
+        """Test a fix implying an impossible speed is rejected and not stored"""
+        device_id = self.device_id("outlier")
+        try:
+            first = self.share_at(device_id, 28.6139)
+            first.raise_for_status()
+            # A degree north, over 100 km, within the same second; retries of it are no new evidence
+            headers = {"Idempotency-Key": uuid.uuid4().hex}
+            suppressed = [self.share_at(device_id, 29.6139, headers).headers.get('X-Location-Suppressed')
+                          for _ in range(4)]
+            stored = self.stored_ids(device_id)
+            success = suppressed == ["outlier"] * 4 and stored == [first.json()['id']]
+            details = f"X-Location-Suppressed: {suppressed}, stored: {len(stored)} points"
+            self.log_test("Outlier Rejection", success, details)
+            return success
+
+        except Exception as e:
+            self.log_test("Outlier Rejection", False, str(e))
+            return False
+
+    def test_outbox_retry(self):
+        """Test a point whose delivery failed is retried until Telegram accepts it"""
+        name = "Outbox Retry"
+        if self.skip_without_standin(name):
+            return True
+        standin = self.standin
+        # A device's first fix is stored and forwarded exactly as sent
+        latitude = round(10 + random.random(), 6)
+        try:
+            standin.failures[latitude] = [500]
+            self.share_at(self.device_id("retry"), latitude).raise_for_status()
+            failed = standin.wait_for(lambda: standin.calls_at(latitude, 500), self.standin_timeout)
+            delivered = failed and standin.wait_for(lambda: standin.calls_at(latitude, 200), self.standin_timeout)
+            success = bool(failed and delivered)
+            details = f"Failed first: {bool(failed)}, delivered on retry: {bool(delivered)}"
+            self.log_test(name, success, details)
+            return success
+
+        except Exception as e:
+            self.log_test(name, False, str(e))
+            return False
+
+    def test_outbox_supersedes_older_point(self):
+        """Test a failed point is never sent after a newer one of its device got through"""
+        name = "Outbox Never Resends Older Point"
+        if self.skip_without_standin(name):
+            return True
+        standin = self.standin
+        device_id = self.device_id("supersede")
+        older = round(20 + random.random(), 6)
+        try:
+            # Only the first send fails, so a stray retry would get through
+            standin.failures[older] = [500]
+            self.share_at(device_id, older).raise_for_status()
+            failed = standin.wait_for(lambda: standin.calls_at(older, 500), self.standin_timeout)
+            newer_from = len(standin.calls)
+            self.share_at(device_id, older + 0.0002).raise_for_status()
+
+            def newer_delivered():
+                return [
+                    n for n, call in enumerate(standin.calls[newer_from:], start=newer_from)
+                    if call["status"] == 200 and call["payload"].get("latitude") not in (None, older)
+                ]
+            delivered = failed and standin.wait_for(newer_delivered, self.standin_timeout)
+            # Give the older point's retry time to come due
+            time.sleep(min(self.standin_timeout, 15))
+            first_newer = newer_delivered()[0] if delivered else None
+            resent = [n for n in standin.calls_at(older) if first_newer is not None and n > first_newer]
+            success = bool(failed and delivered) and not resent
+            details = f"Newer delivered: {bool(delivered)}, older sent again after it: {len(resent)} times"
+            self.log_test(name, success, details)
+            return success
+
+        except Exception as e:
+            self.log_test(name, False, str(e))
+            return False
+
+    def test_outbox_dead_letter(self):
+        """Test a point Telegram keeps refusing ends up dead-lettered"""
+        name = "Outbox Dead Letter"
+        if self.skip_without_standin(name):
+            return True
+        standin = self.standin
+        try:
+            dead_before = requests.get(f"{self.api_url}/telegram/stats", timeout=10).json()["outbox"]["dead"]
+            standin.status = 500
+            self.share_at(self.device_id("dead"), round(30 + random.random(), 6)).raise_for_status()
+
+            def dead_now():
+                return requests.get(f"{self.api_url}/telegram/stats", timeout=10).json()["outbox"]["dead"]
+            success = standin.wait_for(lambda: dead_now() > dead_before, self.standin_timeout)
+            standin.status = 200
+            details = f"Dead-lettered rows: {dead_before} -> {dead_now()}"
+            self.log_test(name, success, details)
+            return success
+
+        except Exception as e:
+            standin.status = 200
+            self.log_test(name, False, str(e))
+            return False
+
+    def test_rate_limit_retry(self):
+        """Test a 429 from Telegram is retried after its retry_after, not dead-lettered"""
+        name = "Telegram Rate Limit Retry"
+        if self.skip_without_standin(name):
+            return True
+        standin = self.standin
+        latitude = round(60 + random.random(), 6)
+        try:
+            standin.failures[latitude] = [429]
+            self.share_at(self.device_id("rate-limited"), latitude).raise_for_status()
+            limited = standin.wait_for(lambda: standin.calls_at(latitude, 429), self.standin_timeout)
+            delivered = limited and standin.wait_for(lambda: standin.calls_at(latitude, 200), self.standin_timeout)
+            waited = None
+            if delivered:
+                waited = (standin.calls[standin.calls_at(latitude, 200)[0]]["at"]
+                          - standin.calls[standin.calls_at(latitude, 429)[0]]["at"])
+            # The stand-in asks for 2 s; allow for clock granularity
+            success = bool(delivered) and waited >= 1.9
+            details = f"Rate limited: {bool(limited)}, delivered: {bool(delivered)}, after {waited}s"
+            self.log_test(name, success, details)
+            return success
+
+        except Exception as e:
+            self.log_test(name, False, str(e))
+            return False
+
+    def test_live_location_edits(self):
+        """Test later points of a device edit its live location message instead of sending new ones"""
+        name = "Live Location Edits"
+        if self.skip_without_standin(name):
+            return True
+        standin = self.standin
+        device_id = self.device_id("live")
+        first = round(50 + random.random(), 6)
+        try:
+            self.share_at(device_id, first).raise_for_status()
+            started = standin.wait_for(lambda: standin.calls_at(first, 200), self.standin_timeout)
+            start = standin.calls[standin.calls_at(first, 200)[0]] if started else {}
+            time.sleep(1)
+            # About 45 m on, a second later: moving, but no outlier. Smoothing moves the
+            # forwarded coordinates, so the edit is found as the next delivered call.
+            after = len(standin.calls)
+            response = self.share_at(device_id, first + 0.0004)
+            response.raise_for_status()
+
+            def next_delivered():
+                return [call for call in standin.calls[after:] if call["status"] == 200]
+            edited = bool(started) and standin.wait_for(next_delivered, self.standin_timeout)
+            call = next_delivered()[0] if edited else {}
+            success = (
+                edited and 'X-Location-Suppressed' not in response.headers
+                and start.get("method") == "sendLocation"
+                and call.get("method") == "editMessageLiveLocation"
+                and call["payload"].get("message_id") == start.get("message_id")
+            )
+            details = (f"Started with {start.get('method')} of message {start.get('message_id')}, "
+                       f"then {call.get('method')} of message {call.get('payload', {}).get('message_id')}")
+            self.log_test(name, success, details)
+            return success
+
+        except Exception as e:
+            self.log_test(name, False, str(e))
+            return False
+
+    def test_circuit_breaker(self):
+        """Test the Telegram circuit opens on repeated failures and closes once a trial call succeeds"""
+        name = "Telegram Circuit Breaker"
+        if self.skip_without_standin(name):
+            return True
+        standin = self.standin
+
+        def circuit():
+            return requests.get(f"{self.api_url}/health", timeout=10).json()["telegram"]["circuit"]
+        try:
+            opened_before = circuit()["times_opened"]
+            standin.status = 500
+            # Every new device's first fix is forwarded, so each share is one more failed call
+            opened = False
+            deadline = time.time() + self.standin_timeout
+            n = 0
+            while not opened and time.time() < deadline:
+                self.share_at(self.device_id(f"breaker-{n}"), round(40 + random.random(), 6)).raise_for_status()
+                n += 1
+                opened = standin.wait_for(lambda: circuit()["state"] == "open", 2)
+            health = requests.get(f"{self.api_url}/health", timeout=10).json()
+            degraded = health["status"] == "degraded"
+            standin.status = 200
+            closed = opened and standin.wait_for(lambda: circuit()["state"] == "closed", self.standin_timeout)
+            state = circuit()
+            success = bool(opened and degraded and closed) and state["times_opened"] > opened_before
+            details = (f"Opened: {bool(opened)} after {n} shares, health while open: {health['status']}, "
+                       f"closed again: {bool(closed)}, times opened: {opened_before} -> {state['times_opened']}")
+            self.log_test(name, success, details)
+            return success
+
+        except Exception as e:
+            standin.status = 200
+            self.log_test(name, False, str(e))
+            return False
+
     def test_clear_locations(self):
         """Test clearing location history"""
         try:
             response = requests.delete(f"{self.api_url}/locations", timeout=10)
-            success = response.status_code == 200
+            success = response.status_code == 202
             
             if success:
-                data = response.json()
-                details = f"Deleted {data.get('deleted_count', 0)} locations"
+                job = response.json()
+                for _ in range(30):
+                    job = requests.get(f"{self.api_url}/jobs/{job['id']}", timeout=10).json()
+                    if job.get("status") in ("done", "failed"):
+                        break
+                    time.sleep(1)
+                success = job.get("status") == "done"
+                details = f"Deleted {job.get('processed', 0)} locations (job {job.get('status')})"
             else:
                 details = f"Status: {response.status_code}, Response: {response.text[:200]}"
             
@@ -128,13 +752,16 @@ class LocationSharingAPITester:
 
     def test_multiple_location_shares(self):
         """Test sharing multiple locations to verify Telegram integration"""
+        # About 45 m apart a second from each other: clearly moving, but well under the speed limit
+        device_id = self.device_id("walk")
         locations = [
-            {"latitude": 28.6139, "longitude": 77.209, "accuracy": 10.0},
-            {"latitude": 28.6140, "longitude": 77.210, "accuracy": 15.0},
-            {"latitude": 28.6141, "longitude": 77.211, "accuracy": 12.0}
+            {"latitude": 28.6139, "longitude": 77.209, "accuracy": 10.0, "device_id": device_id},
+            {"latitude": 28.6143, "longitude": 77.209, "accuracy": 15.0, "device_id": device_id},
+            {"latitude": 28.6147, "longitude": 77.209, "accuracy": 12.0, "device_id": device_id}
         ]
         
         successful_shares = 0
+        shared_ids = []
         for i, location in enumerate(locations):
             try:
                 response = requests.post(
@@ -143,9 +770,13 @@ class LocationSharingAPITester:
                     headers={'Content-Type': 'application/json'},
                     timeout=15
                 )
-                if response.status_code == 200:
+                suppressed = response.headers.get('X-Location-Suppressed')
+                if response.status_code == 200 and suppressed is None:
                     successful_shares += 1
+                    shared_ids.append(response.json()['id'])
                     print(f"  Location {i+1}/3 shared successfully")
+                elif response.status_code == 200:
+                    print(f"  Location {i+1}/3 suppressed: {suppressed}")
                 else:
                     print(f"  Location {i+1}/3 failed: {response.status_code}")
                 
@@ -155,8 +786,13 @@ class LocationSharingAPITester:
             except Exception as e:
                 print(f"  Location {i+1}/3 failed: {str(e)}")
         
-        success = successful_shares == len(locations)
-        details = f"Successfully shared {successful_shares}/{len(locations)} locations"
+        try:
+            stored = self.stored_ids(device_id)
+        except Exception as e:
+            stored = []
+            print(f"  Fetching stored locations failed: {str(e)}")
+        success = successful_shares == len(locations) and stored == shared_ids[::-1]
+        details = f"Successfully shared {successful_shares}/{len(locations)} locations, {len(stored)} stored"
         self.log_test("Multiple Location Shares", success, details)
         return success
 
@@ -171,6 +807,9 @@ class LocationSharingAPITester:
             print("❌ API is not accessible. Stopping tests.")
             return False
         
+        # Test health and the Telegram circuit state
+        self.test_health()
+        
         # Test location sharing (includes Telegram integration)
         success, shared_location = self.test_share_location()
         if not success:
@@ -182,6 +821,50 @@ class LocationSharingAPITester:
         # Test multiple location shares to verify Telegram bot
         self.test_multiple_location_shares()
         
+        # Test cursor pagination over the shared locations
+        self.test_paginate_locations()
+        
+        # Test batch upload statuses and duplicate handling
+        self.test_batch_upload()
+        
+        # Test delta fetches with since_id
+        self.test_since_id()
+        
+        # Test conditional requests on the history
+        self.test_etag()
+        
+        # Test long ranges are served from rollups
+        self.test_resolution_auto()
+        
+        # Test live updates pushed over the WebSocket
+        self.test_websocket_updates()
+        
+        # Test the Server-Sent Events stream and its resume
+        self.test_sse_stream()
+        
+        # Test retried shares are deduplicated by Idempotency-Key
+        self.test_idempotency_key()
+        
+        # Test points that barely moved are not stored
+        self.test_stationary_suppression()
+        
+        # Test fixes implying impossible speeds are rejected
+        self.test_outlier_rejection()
+        
+        # Test durable Telegram delivery against the stand-in Bot API
+        self.test_outbox_retry()
+        self.test_outbox_supersedes_older_point()
+        self.test_outbox_dead_letter()
+        
+        # Test Telegram's 429 answers are waited out and retried
+        self.test_rate_limit_retry()
+        
+        # Test a device's later points edit its live location message
+        self.test_live_location_edits()
+        
+        # Test the Telegram circuit breaker opens and recovers
+        self.test_circuit_breaker()
+        
         # Test clearing locations
         self.test_clear_locations()
         
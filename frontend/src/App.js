@@ -20,6 +20,26 @@ L.Icon.Default.mergeOptions({
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
+const WS_URL = `${BACKEND_URL.replace(/^http/, "ws")}/api/ws/locations`;
+const STREAM_URL = `${API}/locations/stream`;
+const MAX_PENDING_LOCATIONS = 5000;
+const DEFAULT_REPORT_INTERVAL_MS = 5000;
+// Why the server turned a fix away (X-Location-Suppressed)
+const SUPPRESSED_MESSAGES = {
+  outlier: "Location not shared: the GPS fix jumped too far",
+  inaccurate: "Location not shared: the GPS fix is too inaccurate",
+};
+
+// Stable per-browser device id so the backend can keep each device's history apart
+const getDeviceId = () => {
+  let deviceId = localStorage.getItem("deviceId");
+  if (!deviceId) {
+    deviceId = crypto.randomUUID();
+    localStorage.setItem("deviceId", deviceId);
+  }
+  return deviceId;
+};
+const MAX_HISTORY = 100;
 
 // Component to recenter map when location changes
 function RecenterMap({ position }) {
@@ -36,33 +56,160 @@ const Home = () => {
   const [isTracking, setIsTracking] = useState(false);
   const [currentLocation, setCurrentLocation] = useState(null);
   const [locationHistory, setLocationHistory] = useState([]);
+  const [reportInterval, setReportInterval] = useState(DEFAULT_REPORT_INTERVAL_MS);
   const intervalRef = useRef(null);
+  const trackingRef = useRef(false);
+  const reportIntervalRef = useRef(DEFAULT_REPORT_INTERVAL_MS);
+  const sessionIdRef = useRef(null);
   const watchIdRef = useRef(null);
+  const pendingRef = useRef([]);
+  const socketRef = useRef(null);
+  const eventSourceRef = useRef(null);
 
   // Fetch location history
   const fetchLocationHistory = async () => {
     try {
-      const response = await axios.get(`${API}/locations`);
+      const response = await axios.get(`${API}/locations`, {
+        params: { device_id: getDeviceId() },
+      });
       setLocationHistory(response.data);
     } catch (error) {
       console.error("Failed to fetch location history:", error);
     }
   };
 
-  // Send location to backend
+  // Merge pushed points into the history, newest first
+  const mergeLocations = (incoming) => {
+    setLocationHistory((previous) => {
+      const seen = new Set(previous.map((loc) => loc.id));
+      const fresh = incoming.filter((loc) => !seen.has(loc.id));
+      if (fresh.length === 0) return previous;
+      return fresh
+        .concat(previous)
+        .sort((a, b) => new Date(b.timestamp) - new Date(a.timestamp))
+        .slice(0, MAX_HISTORY);
+    });
+  };
+
+  // Server-Sent Events fallback for networks that break WebSockets
+  const connectEventStream = () => {
+    const source = new EventSource(`${STREAM_URL}?device_id=${encodeURIComponent(getDeviceId())}`);
+    eventSourceRef.current = source;
+    source.addEventListener("location", (event) => {
+      mergeLocations([JSON.parse(event.data)]);
+    });
+  };
+
+  // Subscribe to live updates, reconnecting with backoff
+  const connectLiveUpdates = (attempt = 0) => {
+    const socket = new WebSocket(`${WS_URL}?device_id=${encodeURIComponent(getDeviceId())}`);
+    let opened = false;
+    socketRef.current = socket;
+    socket.onopen = () => {
+      opened = true;
+      attempt = 0;
+    };
+    socket.onmessage = (event) => {
+      const message = JSON.parse(event.data);
+      if (message.type === "snapshot") {
+        mergeLocations(message.locations);
+      } else if (message.type === "location") {
+        mergeLocations([message.location]);
+      }
+    };
+    socket.onclose = () => {
+      if (socketRef.current !== socket) return;
+      if (!opened && attempt === 0) {
+        // The WebSocket never got through; EventSource resumes by itself
+        socketRef.current = null;
+        connectEventStream();
+        return;
+      }
+      const delay = Math.min(30000, 1000 * 2 ** attempt);
+      setTimeout(() => {
+        if (socketRef.current === socket) connectLiveUpdates(attempt + 1);
+      }, delay);
+    };
+  };
+
+  // Upload points buffered while the backend was unreachable
+  const flushPendingLocations = async () => {
+    const pending = pendingRef.current;
+    if (pending.length === 0) return;
+    pendingRef.current = [];
+    try {
+      await axios.post(`${API}/locations/batch`, pending);
+    } catch (error) {
+      console.error("Failed to upload buffered locations:", error);
+      pendingRef.current = pending.concat(pendingRef.current).slice(-MAX_PENDING_LOCATIONS);
+    }
+  };
+
+  // Send location to backend; resolves to the delay before the next report
   const shareLocation = async (latitude, longitude, accuracy) => {
+    // Client-generated id makes a retried or re-uploaded point safe to resend
+    const id = crypto.randomUUID();
     try {
-      await axios.post(`${API}/location/share`, {
+      const response = await axios.post(`${API}/location/share`, {
+        id,
+        device_id: getDeviceId(),
+        session_id: sessionIdRef.current,
         latitude,
         longitude,
         accuracy,
       });
-      toast.success("Location shared to Telegram!");
-      await fetchLocationHistory();
+      // Set when the server kept the point out of history and Telegram
+      const suppressed = response.headers["x-location-suppressed"];
+      if (!suppressed) {
+        toast.success("Location shared to Telegram!");
+      } else if (suppressed !== "stationary") {
+        // Standing still is expected and not worth a toast; a bad fix is
+        toast.warning(SUPPRESSED_MESSAGES[suppressed] || "Location not shared");
+      }
+      if (response.data.next_report_ms) {
+        reportIntervalRef.current = response.data.next_report_ms;
+        setReportInterval(response.data.next_report_ms);
+      }
+      await flushPendingLocations();
     } catch (error) {
       console.error("Failed to share location:", error);
       toast.error("Failed to share location");
+      pendingRef.current.push({
+        id,
+        device_id: getDeviceId(),
+        session_id: sessionIdRef.current,
+        latitude,
+        longitude,
+        accuracy,
+        timestamp: new Date().toISOString(),
+      });
+      if (pendingRef.current.length > MAX_PENDING_LOCATIONS) {
+        pendingRef.current.shift();
+      }
     }
+    return reportIntervalRef.current;
+  };
+
+  // Report once after delay, then at whatever interval the server recommends
+  const scheduleReport = (delay) => {
+    intervalRef.current = setTimeout(() => {
+      navigator.geolocation.getCurrentPosition(
+        async (position) => {
+          const { latitude, longitude, accuracy } = position.coords;
+          const next = await shareLocation(latitude, longitude, accuracy);
+          if (trackingRef.current) scheduleReport(next);
+        },
+        (error) => {
+          console.error("Error getting location:", error);
+          if (trackingRef.current) scheduleReport(reportIntervalRef.current);
+        },
+        {
+          enableHighAccuracy: true,
+          timeout: 5000,
+          maximumAge: 0,
+        }
+      );
+    }, delay);
   };
 
   // Start tracking location
@@ -73,6 +220,7 @@ const Home = () => {
     }
 
     setIsTracking(true);
+    sessionIdRef.current = crypto.randomUUID();
     toast.success("Location tracking started");
 
     // Watch position continuously
@@ -92,30 +240,17 @@ const Home = () => {
       }
     );
 
-    // Send location every 5 seconds
-    intervalRef.current = setInterval(() => {
-      navigator.geolocation.getCurrentPosition(
-        (position) => {
-          const { latitude, longitude, accuracy } = position.coords;
-          shareLocation(latitude, longitude, accuracy);
-        },
-        (error) => {
-          console.error("Error getting location:", error);
-        },
-        {
-          enableHighAccuracy: true,
-          timeout: 5000,
-          maximumAge: 0,
-        }
-      );
-    }, 5000);
+    // Send location at the server-recommended interval
+    trackingRef.current = true;
+    scheduleReport(reportIntervalRef.current);
   };
 
   // Stop tracking location
   const stopTracking = () => {
     setIsTracking(false);
+    trackingRef.current = false;
     if (intervalRef.current) {
-      clearInterval(intervalRef.current);
+      clearTimeout(intervalRef.current);
       intervalRef.current = null;
     }
     if (watchIdRef.current) {
@@ -126,10 +261,21 @@ const Home = () => {
   };
 
   // Clear location history
+  const waitForJob = async (jobId) => {
+    for (;;) {
+      const { data } = await axios.get(`${API}/jobs/${jobId}`);
+      if (data.status === "done" || data.status === "failed") return data;
+      await new Promise((resolve) => setTimeout(resolve, 1000));
+    }
+  };
+
   const clearHistory = async () => {
     try {
-      await axios.delete(`${API}/locations`);
+      // Deletion runs as a background job on the server
+      const { data: job } = await axios.delete(`${API}/locations`);
       setLocationHistory([]);
+      const finished = await waitForJob(job.id);
+      if (finished.status === "failed") throw new Error(finished.error);
       toast.success("Location history cleared");
     } catch (error) {
       console.error("Failed to clear history:", error);
@@ -139,8 +285,14 @@ const Home = () => {
 
   useEffect(() => {
     fetchLocationHistory();
+    connectLiveUpdates();
     return () => {
-      if (intervalRef.current) clearInterval(intervalRef.current);
+      const socket = socketRef.current;
+      socketRef.current = null;
+      if (socket) socket.close();
+      if (eventSourceRef.current) eventSourceRef.current.close();
+      trackingRef.current = false;
+      if (intervalRef.current) clearTimeout(intervalRef.current);
       if (watchIdRef.current) navigator.geolocation.clearWatch(watchIdRef.current);
     };
   }, []);
@@ -159,7 +311,7 @@ const Home = () => {
             Live Location Share
           </h1>
           <p className="text-lg text-gray-600">
-            Share your location to Telegram every 5 seconds
+            Share your location to Telegram as you move
           </p>
         </div>
 
@@ -291,7 +443,7 @@ const Home = () => {
                 </div>
                 {isTracking && (
                   <p className="text-sm text-gray-600 mt-2">
-                    Sharing location every 5 seconds
+                    Sharing location every {Math.round(reportInterval / 1000)} seconds
                   </p>
                 )}
               </CardContent>